@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+'''
+Benchmark rover on a synthetic amplicon data set.
+
+Generates a data set with benchmark.synthetic (or reuses the one already in
+the working directory), then times the main stages of rover on the first
+sample: lookup_reads, make_base_seq, parse_md, read_variants and
+process_blocks. It then times end-to-end runs of process_bams over all of
+the samples, first with the default options (the reference run) and then
+with each set of --compare options. The outputs of every compared run must
+be byte-for-byte identical to those of the reference run. The outputs of
+the reference run can also be checked against (or saved as) a golden copy.
+
+Throughput (reads/s, pairs/s) and peak resident set size are written to
+a JSON results file. The exit status is non-zero if any outputs differ.
+
+Example usage:
+python -m benchmark.bench --workdir bench --amplicons 200 --depth 1000 \\
+    --compare="--engine sweep" --compare="--jobs 4 --splitblocks"
+'''
+
+from argparse import ArgumentParser
+import json
+import logging
+import os
+import platform
+import resource
+import shlex
+import shutil
+import sys
+import time
+import pysam
+from rover import rover
+from benchmark.synthetic import (add_generator_arguments, generate, generator_version)
+
+golden_parameters_filename = 'parameters.json'
+# generator arguments which do not change the data set
+non_data_arguments = ['workdir', 'reuse', 'results', 'golden', 'updategolden', 'compare',
+                      'verbose']
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmark rover on a synthetic amplicon data set")
+    parser.add_argument('--workdir', metavar='DIR', type=str, required=True,
+        help='Directory for the data set and the outputs of each run.')
+    parser.add_argument('--reuse', action='store_true', default=False,
+        help='Reuse the data set in the working directory if it was generated '
+             'with the same parameters.')
+    parser.add_argument('--results', metavar='FILE', type=str,
+        help='Write the results to FILE in JSON format, defaults to '
+             'results.json in the working directory.')
+    parser.add_argument('--golden', metavar='DIR', type=str,
+        help='Check the outputs of the reference run against the golden copy in DIR.')
+    parser.add_argument('--updategolden', action='store_true', default=False,
+        help='Save the outputs of the reference run as the golden copy in --golden DIR, '
+             'instead of checking them.')
+    parser.add_argument('--compare', metavar='OPTIONS', type=str, action='append',
+        default=[],
+        help='Extra rover options, such as --compare="--engine sweep" (joined with = '
+             'since they start with a dash), for a run whose outputs are compared '
+             'with the reference run. May be given more than once.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+        help='Log the progress of every block and every read without a pair, as '
+             'rover --verbose does, and include the cost of that logging in the timings.')
+    add_generator_arguments(parser)
+    return parser.parse_args()
+
+
+def data_parameters(args):
+    parameters = dict((name, value) for name, value in sorted(vars(args).items())
+                      if name not in non_data_arguments)
+    parameters['generator_version'] = generator_version
+    return parameters
+
+
+def peak_rss_kb():
+    '''Peak resident set size of this process and of its (waited for)
+    children, in kilobytes on Linux.'''
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def stage_result(seconds, reads=None, pairs=None, **counts):
+    result = {'seconds': seconds, 'peak_rss_kb': peak_rss_kb()}
+    if reads is not None:
+        result['reads'] = reads
+        result['reads_per_second'] = reads / seconds if seconds > 0 else None
+    if pairs is not None:
+        result['pairs'] = pairs
+        result['pairs_per_second'] = pairs / seconds if seconds > 0 else None
+    result.update(counts)
+    return result
+
+
+def prepare_data(args):
+    '''Generate the data set, or reuse it when allowed and its parameters
+    have not changed. Returns the primer file and the bam files.'''
+    datadir = os.path.join(args.workdir, 'data')
+    parameters_filename = os.path.join(datadir, golden_parameters_filename)
+    parameters = data_parameters(args)
+    if args.reuse and os.path.exists(parameters_filename):
+        with open(parameters_filename) as parameters_file:
+            if json.load(parameters_file) == parameters:
+                logging.info('reusing data set in {}'.format(datadir))
+                primers_filename = os.path.join(datadir, 'primers.tsv')
+                bam_filenames = [os.path.join(datadir, 'sample{}.bam'.format(index + 1))
+                                 for index in range(args.samples)]
+                return primers_filename, bam_filenames
+    if os.path.isdir(datadir):
+        shutil.rmtree(datadir)
+    primers_filename, bam_filenames = generate(args, datadir)
+    with open(parameters_filename, 'w') as parameters_file:
+        json.dump(parameters, parameters_file, indent=4, sort_keys=True)
+    return primers_filename, bam_filenames
+
+
+def rover_args(primers_filename, bam_filenames, outdir, options):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    argv = ['--primers', primers_filename,
+            '--out', os.path.join(outdir, 'variants'),
+            '--coverdir', outdir] + options + bam_filenames
+    return rover.parse_args(argv)
+
+
+def output_filenames(bam_filenames):
+    return ['variants', 'variants.binned'] + \
+        [rover.sample_name(bam_filename) + '.coverage' for bam_filename in bam_filenames]
+
+
+def compare_outputs(expected_dir, actual_dir, bam_filenames):
+    '''Return the names of the output files which are missing from actual_dir
+    or differ from those in expected_dir.'''
+    differences = []
+    for filename in output_filenames(bam_filenames):
+        expected_filename = os.path.join(expected_dir, filename)
+        actual_filename = os.path.join(actual_dir, filename)
+        if not (os.path.exists(expected_filename) and os.path.exists(actual_filename)):
+            differences.append(filename)
+            continue
+        with open(expected_filename, 'rb') as expected, open(actual_filename, 'rb') as actual:
+            if expected.read() != actual.read():
+                differences.append(filename)
+    return differences
+
+
+def count_pairs(outdir, bam_filenames):
+    '''Total number of read pairs in the coverage files of a run.'''
+    total = 0
+    for bam_filename in bam_filenames:
+        coverage_filename = os.path.join(outdir, rover.sample_name(bam_filename) + '.coverage')
+        with open(coverage_filename) as coverage_file:
+            next(coverage_file)
+            for line in coverage_file:
+                total += int(line.split('\t')[3])
+    return total
+
+
+def count_reads(bam_filenames):
+    total = 0
+    for bam_filename in bam_filenames:
+        with pysam.Samfile(bam_filename, "rb") as bam:
+            total += bam.mapped + bam.unmapped
+    return total
+
+
+def stage_benchmarks(primers_filename, bam_filename, outdir):
+    '''Time each stage of rover separately on a single bam file.'''
+    options = rover_args(primers_filename, [bam_filename], outdir, [])
+    block_coords = rover.get_block_coords(primers_filename)
+    blocks = [(chr, int(start), int(end)) for chr, start, end in
+              (block_info[:3] for block_info in block_coords)]
+    stages = {}
+    with pysam.Samfile(bam_filename, "rb") as bam:
+        start_time = time.time()
+        block_read_pairs = [rover.lookup_reads(options.overlap, bam, chr, start - 1, end - 1)
+                            for chr, start, end in blocks]
+        seconds = time.time() - start_time
+        reads = [read for read_pairs in block_read_pairs
+                 for block_reads in read_pairs.values() for read in block_reads]
+        num_pairs = sum(1 for read_pairs in block_read_pairs
+                        for block_reads in read_pairs.values() if len(block_reads) == 2)
+        stages['lookup_reads'] = stage_result(seconds, reads=len(reads), pairs=num_pairs)
+
+        start_time = time.time()
+        base_seqs = [rover.make_base_seq(read.qname, read.query_sequence, read.query_qualities)
+                     for read in reads]
+        stages['make_base_seq'] = stage_result(time.time() - start_time, reads=len(reads))
+
+        mds = [rover.get_MD(read) for read in reads]
+        start_time = time.time()
+        for md in mds:
+            if md:
+                rover.tokenize_md(md)
+        stages['parse_md_uncached'] = stage_result(time.time() - start_time, reads=len(reads))
+        rover.md_cache = rover.LRUCache(rover.md_cache_size)
+        start_time = time.time()
+        parsed_mds = [rover.parse_md(md) for md in mds]
+        stages['parse_md'] = stage_result(time.time() - start_time, reads=len(reads),
+            distinct_md=len(set(mds)))
+
+        start_time = time.time()
+        num_variants = 0
+        for read, (bases, qualities), md in zip(reads, base_seqs, parsed_mds):
+            num_variants += len(rover.read_variants(options, read.qname, read.pos + 1,
+                bases, qualities, read.cigar, md))
+        stages['read_variants'] = stage_result(time.time() - start_time, reads=len(reads),
+            variants=num_variants)
+
+        del block_read_pairs, reads, base_seqs, parsed_mds
+        start_time = time.time()
+        block_results = rover.process_blocks(options, bam, block_coords)
+        stages['process_blocks'] = stage_result(time.time() - start_time,
+            reads=count_reads([bam_filename]),
+            pairs=sum(block.num_pairs for block in block_results))
+    return stages
+
+
+def end_to_end(primers_filename, bam_filenames, outdir, options, total_reads):
+    '''Time a full run of process_bams over all of the samples.'''
+    rover_options = rover_args(primers_filename, bam_filenames, outdir, options)
+    start_time = time.time()
+    rover.process_bams(rover_options)
+    seconds = time.time() - start_time
+    result = stage_result(seconds, reads=total_reads,
+        pairs=count_pairs(outdir, bam_filenames))
+    result['options'] = ' '.join(options)
+    return result
+
+
+def check_golden(args, reference_dir, bam_filenames):
+    parameters = data_parameters(args)
+    parameters_filename = os.path.join(args.golden, golden_parameters_filename)
+    if args.updategolden:
+        if not os.path.isdir(args.golden):
+            os.makedirs(args.golden)
+        for filename in output_filenames(bam_filenames):
+            shutil.copy(os.path.join(reference_dir, filename), os.path.join(args.golden, filename))
+        with open(parameters_filename, 'w') as parameters_file:
+            json.dump(parameters, parameters_file, indent=4, sort_keys=True)
+        return {'updated': True, 'identical': True, 'differences': []}
+    with open(parameters_filename) as parameters_file:
+        if json.load(parameters_file) != parameters:
+            exit('The golden outputs in {} were made from a data set with different parameters'
+                 .format(args.golden))
+    differences = compare_outputs(args.golden, reference_dir, bam_filenames)
+    return {'updated': False, 'identical': not differences, 'differences': differences}
+
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    # log rover's progress the same way the rover program does, so that the
+    # cost of logging is included in the timings
+    logging.basicConfig(
+        filename=os.path.join(args.workdir, 'bench.log'),
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        filemode='w',
+        format='%(asctime)s %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S')
+    primers_filename, bam_filenames = prepare_data(args)
+    total_reads = count_reads(bam_filenames)
+    results = {
+        'rover_version': rover.rover_version,
+        'python_version': platform.python_version(),
+        'pysam_version': pysam.__version__,
+        'parameters': data_parameters(args),
+        'reads': total_reads,
+    }
+    runsdir = os.path.join(args.workdir, 'runs')
+    if os.path.isdir(runsdir):
+        shutil.rmtree(runsdir)
+    results['stages'] = stage_benchmarks(primers_filename, bam_filenames[0],
+        os.path.join(runsdir, 'stages'))
+    reference_dir = os.path.join(runsdir, 'reference')
+    runs = [end_to_end(primers_filename, bam_filenames, reference_dir, [], total_reads)]
+    identical = True
+    for index, options in enumerate(args.compare):
+        outdir = os.path.join(runsdir, 'compare{}'.format(index + 1))
+        run = end_to_end(primers_filename, bam_filenames, outdir, shlex.split(options), total_reads)
+        run['differences'] = compare_outputs(reference_dir, outdir, bam_filenames)
+        run['identical'] = not run['differences']
+        identical = identical and run['identical']
+        runs.append(run)
+    results['end_to_end'] = runs
+    if args.golden is not None:
+        results['golden'] = check_golden(args, reference_dir, bam_filenames)
+        identical = identical and results['golden']['identical']
+    results['peak_rss_kb'] = peak_rss_kb()
+    results_filename = args.results
+    if results_filename is None:
+        results_filename = os.path.join(args.workdir, 'results.json')
+    with open(results_filename, 'w') as results_file:
+        json.dump(results, results_file, indent=4, sort_keys=True)
+    for run in runs:
+        sys.stdout.write('{:<40} {:>8.2f}s {:>12.0f} reads/s {:>10.0f} pairs/s {}\n'.format(
+            run['options'] or '(reference)', run['seconds'], run['reads_per_second'],
+            run['pairs_per_second'],
+            '' if run.get('identical', True) else 'DIFFERS: ' + ' '.join(run['differences'])))
+    if 'golden' in results and not results['golden']['identical']:
+        sys.stdout.write('golden outputs differ: {}\n'.format(' '.join(results['golden']['differences'])))
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+'''
+Generate a synthetic PCR amplicon data set for benchmarking rover.
+
+The data set consists of a random reference genome, a set of amplicons
+tiled along each chromosome, a coordinate sorted and indexed BAM file for
+each sample, and a TSV file of the primer blocks in the format expected
+by rover's --primers argument.
+
+Each read pair is one amplicon fragment, sequenced in full from both
+ends, so both reads of a pair span the whole amplicon. Each amplicon has
+one heterozygous variant (an SNV, insertion or deletion) carried by
+around half of its fragments. On top of that, each fragment carries
+random SNVs and indels at the given rates (which appear in both of its
+reads), and each read carries random sequencing errors (which appear only
+in that read). A small proportion of fragments lose a read, or have a
+duplicated (secondary) read, so that orphans and groups of more than two
+reads are exercised as well.
+
+Example usage:
+python -m benchmark.synthetic --outdir data --samples 4 --amplicons 500
+
+Everything is derived from --seed, so the same arguments always produce
+the same data set.
+'''
+
+from argparse import ArgumentParser
+import random
+import os
+import pysam
+
+default_samples = 2
+default_chromosomes = 2
+default_amplicons = 100
+default_depth = 500
+default_read_length = 150
+default_overlap = 30
+default_primer_length = 20
+default_mismatch_rate = 0.002
+default_indel_rate = 0.0005
+default_error_rate = 0.002
+default_quality_profile = 'decay'
+default_seed = 1
+# changed whenever the same arguments generate a different data set, so that
+# data sets and golden outputs made by an older generator are not reused
+generator_version = 2
+# proportion of fragments which carry the heterozygous variant of their amplicon
+het_variant_fraction = 0.4
+# proportion of fragments with only one read
+orphan_fraction = 0.01
+# proportion of fragments with a duplicated first read
+duplicate_fraction = 0.005
+# no random edits are made this close to either end of a read
+edit_margin = 5
+# distance to the end of the chromosome after the last amplicon
+chromosome_padding = 500
+BASES = 'ACGT'
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--samples', metavar='N', type=int,
+        default=default_samples,
+        help='Number of samples (BAM files). Defaults to {}.'.format(default_samples))
+    parser.add_argument('--chromosomes', metavar='N', type=int,
+        default=default_chromosomes,
+        help='Number of chromosomes. Defaults to {}.'.format(default_chromosomes))
+    parser.add_argument('--amplicons', metavar='N', type=int,
+        default=default_amplicons,
+        help='Number of amplicons per chromosome. Defaults to {}.'.format(default_amplicons))
+    parser.add_argument('--depth', metavar='N', type=int,
+        default=default_depth,
+        help='Number of read pairs per amplicon. Defaults to {}.'.format(default_depth))
+    parser.add_argument('--readlen', metavar='N', type=int,
+        default=default_read_length,
+        help='Length of the reads, which is also the length of the amplicons. '
+             'Defaults to {}.'.format(default_read_length))
+    parser.add_argument('--ampliconoverlap', metavar='N', type=int,
+        default=default_overlap,
+        help='Number of bases by which neighbouring amplicons overlap. '
+             'Defaults to {}.'.format(default_overlap))
+    parser.add_argument('--primerlen', metavar='N', type=int,
+        default=default_primer_length,
+        help='Length of the primers at each end of an amplicon. '
+             'Defaults to {}.'.format(default_primer_length))
+    parser.add_argument('--mismatchrate', metavar='P', type=float,
+        default=default_mismatch_rate,
+        help='Per base rate of SNVs in a fragment. '
+             'Defaults to {}.'.format(default_mismatch_rate))
+    parser.add_argument('--indelrate', metavar='P', type=float,
+        default=default_indel_rate,
+        help='Per base rate of insertions and deletions in a fragment. '
+             'Defaults to {}.'.format(default_indel_rate))
+    parser.add_argument('--errorrate', metavar='P', type=float,
+        default=default_error_rate,
+        help='Per base rate of sequencing errors in a read. '
+             'Defaults to {}.'.format(default_error_rate))
+    parser.add_argument('--qualprofile', choices=['flat', 'decay', 'random'],
+        default=default_quality_profile,
+        help='Shape of the base quality scores along a read. '
+             'Defaults to {}.'.format(default_quality_profile))
+    parser.add_argument('--seed', metavar='N', type=int,
+        default=default_seed,
+        help='Seed for the random number generator. Defaults to {}.'.format(default_seed))
+
+
+def parse_args():
+    parser = ArgumentParser(description="Generate a synthetic amplicon data set for rover")
+    parser.add_argument('--outdir', metavar='DIR', type=str, required=True,
+        help='Directory to write the data set to, created if it does not exist.')
+    add_generator_arguments(parser)
+    return parser.parse_args()
+
+
+def other_bases(base):
+    return [b for b in BASES if b != base]
+
+
+def random_mismatch(rng):
+    '''An SNV, as the index of its base among the three bases other than the
+    reference base. The reference base is only known when the read is made,
+    as an indel earlier in the read shifts the reference position of the
+    offsets after it.'''
+    return ('X', rng.randrange(3))
+
+
+def random_indel(rng):
+    if rng.random() < 0.5:
+        return ('I', ''.join(rng.choice(BASES) for _ in range(rng.randint(1, 3))))
+    else:
+        return ('D', rng.randint(1, 3))
+
+
+def random_edit(rng):
+    '''An SNV, insertion or deletion, with SNVs being the most common.'''
+    if rng.random() < 0.5:
+        return random_mismatch(rng)
+    else:
+        return random_indel(rng)
+
+
+def fragment_edits(rng, params, het_offset, het_edit):
+    '''The edits made to one fragment, as a dictionary from offset in the
+    amplicon to edit. Edits are kept apart so that they never interact.'''
+    edits = {}
+    if rng.random() < het_variant_fraction:
+        edits[het_offset] = het_edit
+    edit_rate = params.mismatchrate + params.indelrate
+    offset = edit_margin
+    while offset < params.readlen - edit_margin:
+        if not any(nearby in edits for nearby in range(offset - 4, offset + 5)):
+            choice = rng.random()
+            if choice < params.mismatchrate:
+                edits[offset] = random_mismatch(rng)
+            elif choice < edit_rate:
+                edits[offset] = random_indel(rng)
+        offset += 1
+    return edits
+
+
+def read_edits(rng, params, edits):
+    '''Add sequencing errors to the edits of a fragment for one read.'''
+    edits = dict(edits)
+    for offset in range(edit_margin, params.readlen - edit_margin):
+        if offset not in edits and rng.random() < params.errorrate:
+            edits[offset] = random_mismatch(rng)
+    return edits
+
+
+def make_read(ref, amplicon_start, read_length, edits):
+    '''Apply the edits to the reference at amplicon_start, returning the
+    sequence, cigar and MD tag of the resulting read.'''
+    seq = []
+    cigar = []
+    md = []
+    match_count = 0
+    ref_pos = amplicon_start
+
+    def add_cigar(code, extent):
+        if cigar and cigar[-1][0] == code:
+            cigar[-1] = (code, cigar[-1][1] + extent)
+        else:
+            cigar.append((code, extent))
+
+    for offset in range(read_length):
+        edit = edits.get(offset)
+        if edit is None:
+            seq.append(ref[ref_pos])
+            add_cigar(0, 1)
+            match_count += 1
+            ref_pos += 1
+        elif edit[0] == 'X':
+            seq.append(other_bases(ref[ref_pos])[edit[1]])
+            add_cigar(0, 1)
+            md.append(str(match_count))
+            md.append(ref[ref_pos])
+            match_count = 0
+            ref_pos += 1
+        else:
+            # indels follow a matching base at this offset
+            seq.append(ref[ref_pos])
+            add_cigar(0, 1)
+            match_count += 1
+            ref_pos += 1
+            if edit[0] == 'I':
+                seq.extend(edit[1])
+                add_cigar(1, len(edit[1]))
+            else:
+                md.append(str(match_count))
+                md.append('^' + ref[ref_pos:ref_pos + edit[1]])
+                match_count = 0
+                add_cigar(2, edit[1])
+                ref_pos += edit[1]
+    md.append(str(match_count))
+    return ''.join(seq), cigar, ''.join(md)
+
+
+def make_qualities(rng, profile, length):
+    if profile == 'flat':
+        return [35] * length
+    elif profile == 'decay':
+        # high quality at the start of the read, tailing off towards the end
+        return [max(2, min(41, int(40 - 25 * float(i) / length + rng.gauss(0, 3))))
+                for i in range(length)]
+    else:
+        return [rng.randint(2, 41) for _ in range(length)]
+
+
+def make_segment(params, rng, name, flag, tid, amplicon_start, seq, cigar, md):
+    segment = pysam.AlignedSegment()
+    segment.query_name = name
+    segment.query_sequence = seq
+    segment.flag = flag
+    segment.reference_id = tid
+    segment.reference_start = amplicon_start
+    segment.mapping_quality = 60
+    segment.cigartuples = cigar
+    segment.next_reference_id = tid
+    segment.next_reference_start = amplicon_start
+    segment.template_length = params.readlen
+    segment.query_qualities = pysam.qualitystring_to_array(
+        ''.join(chr(33 + q) for q in make_qualities(rng, params.qualprofile, len(seq))))
+    segment.set_tag('MD', md)
+    return segment
+
+
+def amplicon_starts(params):
+    step = params.readlen - params.ampliconoverlap
+    return [chromosome_padding + amplicon * step for amplicon in range(params.amplicons)]
+
+
+def make_reference(params):
+    rng = random.Random(params.seed)
+    length = amplicon_starts(params)[-1] + params.readlen + chromosome_padding
+    return [('chr{}'.format(index + 1), ''.join(rng.choice(BASES) for _ in range(length)))
+            for index in range(params.chromosomes)]
+
+
+def write_primers(params, reference, primers_filename):
+    '''Write the primer blocks (the amplicons without their primers) in 1 based
+    coordinates.'''
+    with open(primers_filename, 'w') as primers_file:
+        for chr, _ref in reference:
+            for start in amplicon_starts(params):
+                primers_file.write('{}\t{}\t{}\n'.format(
+                    chr, start + params.primerlen + 1, start + params.readlen - params.primerlen))
+
+
+def write_sample(params, reference, sample_index, bam_filename):
+    rng = random.Random(params.seed * 1000 + sample_index + 1)
+    header = {'HD': {'VN': '1.0', 'SO': 'unsorted'},
+              'SQ': [{'SN': chr, 'LN': len(ref)} for chr, ref in reference]}
+    unsorted_filename = bam_filename + '.unsorted'
+    fragment = 0
+    with pysam.AlignmentFile(unsorted_filename, 'wb', header=header) as bam:
+        for tid, (chr, ref) in enumerate(reference):
+            for amplicon_start in amplicon_starts(params):
+                het_offset = rng.randint(2 * edit_margin, params.readlen - 2 * edit_margin)
+                het_edit = random_edit(rng)
+                for _ in range(params.depth):
+                    fragment += 1
+                    name = 'frag{}'.format(fragment)
+                    edits = fragment_edits(rng, params, het_offset, het_edit)
+                    orphan = rng.random() < orphan_fraction
+                    duplicate = rng.random() < duplicate_fraction
+                    for mate_flag in (0x40 | 0x20, 0x80 | 0x10):
+                        if orphan and mate_flag & 0x80:
+                            continue
+                        seq, cigar, md = make_read(ref, amplicon_start, params.readlen,
+                            read_edits(rng, params, edits))
+                        segment = make_segment(params, rng, name, 0x1 | 0x2 | mate_flag,
+                            tid, amplicon_start, seq, cigar, md)
+                        bam.write(segment)
+                        if duplicate and mate_flag & 0x40:
+                            segment.flag |= 0x100
+                            bam.write(segment)
+    pysam.sort('-o', bam_filename, unsorted_filename)
+    os.remove(unsorted_filename)
+    pysam.index(bam_filename)
+
+
+def generate(params, outdir):
+    '''Generate a data set in outdir, returning the name of the primer file
+    and the names of the BAM files.'''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    reference = make_reference(params)
+    primers_filename = os.path.join(outdir, 'primers.tsv')
+    write_primers(params, reference, primers_filename)
+    bam_filenames = []
+    for sample_index in range(params.samples):
+        bam_filename = os.path.join(outdir, 'sample{}.bam'.format(sample_index + 1))
+        write_sample(params, reference, sample_index, bam_filename)
+        bam_filenames.append(bam_filename)
+    return primers_filename, bam_filenames
+
+
+def main():
+    args = parse_args()
+    generate(args, args.outdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+A library interface to rover, for pipelines which already have the reads
+of a sample in memory, or an open alignment file, and want the variant
+calls back as Python objects rather than files.
+
+A RoverCaller is configured once with the primer blocks and the thresholds
+(with the same defaults as the rover command line), and can then tally any
+number of samples:
+
+    from rover import RoverCaller
+
+    caller = RoverCaller('primers.tsv', proportionthresh=0.1)
+    with pysam.AlignmentFile('sample1.bam') as bam:
+        tally = caller.tally_region(bam)
+    for call in caller.call(tally):
+        if call.kept:
+            print call.chr, call.pos, call.ref, call.alt, call.proportion
+    for coverage in tally.coverage():
+        print coverage.chr, coverage.start, coverage.end, coverage.num_pairs
+
+The reads can also be any iterable of pysam AlignedSegments (tally_reads),
+such as the output of an earlier stage of the pipeline. Nothing is written
+to disk unless sinks are given to call: any object with the add_variant and
+close methods of the VCF and matrix outputs of the vcf and matrix modules.
+'''
+
+from argparse import Namespace
+from rover import (default_minimum_read_overlap_block, default_proportion_threshold,
+                   default_absolute_threshold, default_engine, default_seed,
+                   new_block_metrics, add_metrics, proportion_overlap, alignment_end,
+                   tally_block, process_blocks, block_calls, may_change_decision)
+from primers import (PrimerIndex, block_table, load_primer_index)
+
+# the end of a region which extends to the end of its chromosome
+region_end_max = 1 << 62
+
+class Tally(object):
+    '''The variant tally of a sample: the BlockResult of each block, in the
+    order of the blocks (see the rover module), before the thresholds are
+    applied.'''
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def coverage(self):
+        '''The Coverage of each block.'''
+        return [Coverage(block.chr, block.start, block.end, block.num_pairs, block.total_pairs)
+                for block in self.blocks]
+
+    def metrics(self):
+        '''The counts and timings of all the blocks (see the metrics module).'''
+        totals = new_block_metrics()
+        for block in self.blocks:
+            add_metrics(totals, block.metrics)
+        return totals
+
+class Coverage(object):
+    '''The number of read pairs in a block, as in the coverage files, and
+    the total number of pairs if they were sampled with maxpairs.'''
+    def __init__(self, chr, start, end, num_pairs, total_pairs):
+        self.chr = chr
+        self.start = start
+        self.end = end
+        self.num_pairs = num_pairs
+        self.total_pairs = total_pairs
+    def __repr__(self):
+        return 'Coverage({!r}, {}, {}, {}, {})'.format(
+            self.chr, self.start, self.end, self.num_pairs, self.total_pairs)
+
+class Call(object):
+    '''A variant of a block (in rover's notation, where '-' stands for the
+    missing allele of an insertion or deletion) which is either kept or
+    binned. num_vars is the number of read pairs containing it, out of the
+    num_pairs its proportion was computed from. recheck is True if its pairs
+    were sampled with maxpairs and it might be kept or binned differently if
+    all of them were tallied.'''
+    def __init__(self, chr, pos, ref, alt, num_vars, num_pairs, kept, recheck=False):
+        self.chr = chr
+        self.pos = pos
+        self.ref = ref
+        self.alt = alt
+        self.num_vars = num_vars
+        self.num_pairs = num_pairs
+        self.kept = kept
+        self.recheck = recheck
+    @property
+    def proportion(self):
+        return float(self.num_vars) / self.num_pairs
+    def __repr__(self):
+        return 'Call({!r}, {}, {!r}, {!r}, {}, {}, {})'.format(
+            self.chr, self.pos, self.ref, self.alt, self.num_vars, self.num_pairs, self.kept)
+
+class RoverCaller(object):
+    '''Tally and call the variants of samples in memory. blocks is the name
+    of a primer TSV file or primer index, a PrimerIndex, or a list of the
+    (chr, start, end) of each block, with 1 based inclusive coordinates. The
+    other arguments have the same meaning as the rover command line
+    options of the same names. Raises ValueError for invalid blocks.'''
+    def __init__(self, blocks, proportionthresh=default_proportion_threshold,
+                 absthresh=default_absolute_threshold, qualthresh=None,
+                 overlap=default_minimum_read_overlap_block, depth=False,
+                 positiondepth=False, maxpairs=None, seed=default_seed,
+                 engine=default_engine, streampairs=False):
+        if isinstance(blocks, PrimerIndex):
+            self.primer_index = blocks
+        elif isinstance(blocks, basestring):
+            self.primer_index = load_primer_index(blocks)
+        else:
+            blocks = [(chr, int(start), int(end)) for chr, start, end in blocks]
+            for chr, start, end in blocks:
+                if not 1 <= start <= end:
+                    raise ValueError('the block {} {} {} is empty or starts before 1'.format(chr, start, end))
+            self.primer_index = PrimerIndex(block_table(blocks))
+        self.blocks = self.primer_index.blocks()
+        # the options of the command line which the processing of the
+        # blocks depends on
+        self.args = Namespace(
+            proportionthresh=proportionthresh, absthresh=absthresh, qualthresh=qualthresh,
+            overlap=overlap, depth=depth, positiondepth=positiondepth, maxpairs=maxpairs,
+            seed=seed, engine=engine, streampairs=streampairs, prefetch=0)
+
+    def tally_reads(self, reads):
+        '''Tally the variants of a sample from an iterable of aligned reads,
+        in any order. The reads of each block are chosen with the same tests
+        as the reads fetched from a bam file, and paired by name.'''
+        min_overlap = self.args.overlap
+        primer_index = self.primer_index
+        metrics = [new_block_metrics() for _block in self.blocks]
+        # the reads of each block, by name
+        read_pairs = [{} for _block in self.blocks]
+        for read in reads:
+            if read.reference_id < 0:
+                continue
+            for block_index in primer_index.overlapping(read.reference_name, read.pos + 1,
+                                                        alignment_end(read)):
+                block_metrics = metrics[block_index]
+                block_metrics['reads'] += 1
+                _chr, start, end = self.blocks[block_index]
+                # only keep reads which overlap with the block region by a certain proportion
+                if proportion_overlap(start - 1, end - 1, read) > min_overlap:
+                    block_metrics['overlapping_reads'] += 1
+                    read_pairs[block_index].setdefault(read.qname, []).append(read)
+        return Tally([tally_block(self.args, chr, start, end, read_pairs[block_index], metrics[block_index])
+                      for block_index, (chr, start, end) in enumerate(self.blocks)])
+
+    def tally_region(self, bam, chr=None, start=None, end=None):
+        '''Tally the variants of a sample from an open, indexed, alignment
+        file, for all the blocks, or the blocks overlapping a region of a
+        chromosome (1 based, inclusive).'''
+        if chr is None:
+            blocks = self.blocks
+        else:
+            block_indices = self.primer_index.overlapping(chr, 1 if start is None else start,
+                                                          region_end_max if end is None else end)
+            blocks = [self.blocks[block_index] for block_index in block_indices]
+        return Tally(process_blocks(self.args, bam, blocks))
+
+    def call(self, tally, sample='sample', sinks=()):
+        '''Keep or bin each variant of a tally, returning a list of Calls in
+        the order of the blocks. Each variant is also passed, with the name
+        of the sample, to the add_variant method of each of the sinks.'''
+        args = self.args
+        calls = []
+        for block in tally.blocks:
+            num_pairs = block.num_pairs
+            total_pairs = block.total_pairs
+            for (pos, ref, alt), num_vars, var_pairs, kept in block_calls(args, block):
+                recheck = num_pairs < total_pairs and may_change_decision(
+                    args, num_vars, var_pairs, var_pairs * float(total_pairs) / num_pairs)
+                calls.append(Call(block.chr, pos, ref, alt, num_vars, var_pairs, kept, recheck))
+                for sink in sinks:
+                    sink.add_variant(sample, block.chr, (pos, ref, alt), num_vars, var_pairs, kept)
+        return calls
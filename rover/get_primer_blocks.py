@@ -9,6 +9,10 @@ chr,start,end (just like the BED file format).
 Example usage:
 ./get_primer_blocks.py --primers data/PALB2_heeled.idt.log --out blocks.tsv
 
+With --index the blocks are also compiled into a primer index (see the
+primers module of rover), which rover accepts in place of the TSV file:
+./get_primer_blocks.py --primers data/PALB2_heeled.idt.log --index blocks.npy
+
 Authors: Bernie Pope (bjpope@unimelb.edu.au)
 Date: 22 September 2013
 '''
@@ -16,6 +20,11 @@ Date: 22 September 2013
 from argparse import (ArgumentParser)
 import sys
 import csv
+try:
+    from rover.primers import (PrimerIndex, block_table)
+except ImportError:
+    # run from the source directory
+    from primers import (PrimerIndex, block_table)
 
 def parse_args():
     parser = ArgumentParser(description="Retrieve the primer block coordinates from the output of the primer design tool")
@@ -24,6 +33,8 @@ def parse_args():
         help='primer coordinates')
     parser.add_argument( '--out', metavar='FILE', type=str,
         help='save primer coordintates in FILE, defaults to stdout')
+    parser.add_argument('--index', metavar='FILE', type=str,
+        help='also save the primer blocks as a compiled primer index in FILE')
     return parser.parse_args() 
 
 def get_block_coords(primers_file):
@@ -63,10 +74,15 @@ def main():
         outfile = sys.stdout
     else:
         outfile = open(args.out, 'w')
+    blocks = []
     with outfile:
         writer = csv.writer(outfile, delimiter='\t')
         for coord in get_block_coords(args.primers):
             writer.writerow(coord)
+            blocks.append(coord)
+    if args.index is not None:
+        chr_blocks = [(chr, int(start), int(end)) for chr, start, end in blocks]
+        PrimerIndex(block_table(chr_blocks)).save(args.index)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,105 @@
+'''
+A sparse variant by sample matrix of the read pair counts of a whole
+cohort, for comparing variants across samples without parsing the text
+outputs.
+
+The rows of the matrix are the distinct variants of all the samples
+(kept or binned), sorted by chromosome (in the order of the primer file),
+position and alleles, and the columns are the samples, in the order they
+were given. The entries are stored in compressed sparse row (CSR) form, in
+PREFIX.matrix.npz (a NumPy .npz file), as these arrays:
+
+    indptr     the entries of row i are entries indptr[i] to indptr[i+1]-1
+    indices    the column (sample) of each entry
+    num_vars   the number of read pairs containing the variant
+    num_pairs  the number of read pairs the proportion was computed from
+    kept       whether the variant was kept (True) or binned (False)
+    shape      the number of rows and columns
+
+so that, for example, scipy.sparse.csr_matrix((num_vars, indices, indptr),
+shape) is the matrix of pair counts. If a sample has the same variant in
+more than one (overlapping) block, the block with the most read pairs is
+used, as for VCF output. PREFIX.matrix.variants.tsv lists the chromosome,
+position, reference and alternative allele of each row (in rover's
+notation), and PREFIX.matrix.samples.tsv the name of each column.
+
+The entries are appended to compact arrays as each sample is written, and
+the matrix is sorted and compressed when the output is closed.
+'''
+
+from array import array
+import numpy as np
+
+def numpy_array(values, dtype):
+    '''Convert an array.array to a numpy array, without a Python object for
+    every value.'''
+    if not values:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=values.typecode).astype(dtype)
+
+class MatrixOutput(object):
+    '''The variant by sample matrix of a run, written to PREFIX.matrix.npz,
+    PREFIX.matrix.variants.tsv and PREFIX.matrix.samples.tsv.'''
+    def __init__(self, prefix, samples, contigs):
+        self.prefix = prefix
+        self.samples = samples
+        self.sample_indices = dict((sample, index) for index, sample in enumerate(samples))
+        self.contig_order = dict((chr, index) for index, chr in enumerate(contigs))
+        # (chr, pos, ref, alt) -> number of the variant, in order of arrival
+        self.variant_ids = {}
+        # the entries, in order of arrival
+        self.rows = array('l')
+        self.columns = array('l')
+        self.num_vars = array('l')
+        self.num_pairs = array('l')
+        self.kept = array('b')
+
+    def add_variant(self, sample, chr, variant, num_vars, num_pairs, kept):
+        pos, ref, alt = variant
+        key = (chr, pos, ref, alt)
+        variant_id = self.variant_ids.get(key)
+        if variant_id is None:
+            variant_id = self.variant_ids[key] = len(self.variant_ids)
+        self.rows.append(variant_id)
+        self.columns.append(self.sample_indices[sample])
+        self.num_vars.append(num_vars)
+        self.num_pairs.append(num_pairs)
+        self.kept.append(kept)
+
+    def sort_key(self, key):
+        chr, pos, ref, alt = key
+        return (self.contig_order.get(chr, len(self.contig_order)), chr, pos, ref, alt)
+
+    def close(self):
+        variants = sorted(self.variant_ids, key=self.sort_key)
+        # the row of each variant number
+        row_of_id = np.zeros(len(variants), dtype=np.int64)
+        for row, key in enumerate(variants):
+            row_of_id[self.variant_ids[key]] = row
+        rows = row_of_id[numpy_array(self.rows, np.int64)]
+        columns = numpy_array(self.columns, np.int32)
+        num_vars = numpy_array(self.num_vars, np.int32)
+        num_pairs = numpy_array(self.num_pairs, np.int32)
+        kept = numpy_array(self.kept, np.bool_)
+        # order the entries by row and column, with the most read pairs
+        # first, and keep the first entry of each row and column
+        order = np.lexsort((-num_pairs, columns, rows))
+        rows, columns = rows[order], columns[order]
+        first = np.ones(len(order), dtype=np.bool_)
+        first[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+        order = order[first]
+        rows = rows[first]
+        indptr = np.zeros(len(variants) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(variants)), out=indptr[1:])
+        np.savez_compressed(self.prefix + '.matrix.npz',
+            indptr=indptr, indices=columns[first], num_vars=num_vars[order],
+            num_pairs=num_pairs[order], kept=kept[order],
+            shape=np.array([len(variants), len(self.samples)], dtype=np.int64))
+        with open(self.prefix + '.matrix.variants.tsv', 'w') as variants_file:
+            variants_file.write('chr\tpos\tref\talt\n')
+            for chr, pos, ref, alt in variants:
+                variants_file.write('{}\t{}\t{}\t{}\n'.format(chr, pos, ref, alt))
+        with open(self.prefix + '.matrix.samples.tsv', 'w') as samples_file:
+            samples_file.write('sample\n')
+            for sample in self.samples:
+                samples_file.write('{}\n'.format(sample))
@@ -0,0 +1,124 @@
+'''
+Structured performance metrics for rover runs.
+
+The metrics of each block are kept in a dictionary, made by
+new_block_metrics, which is filled in while the block is processed and
+travels back from the worker processes with the block's results. The
+counts are:
+
+    reads              reads intersecting the block
+    overlapping_reads  reads which sufficiently overlap the block (--overlap)
+    pairs              read pairs (both reads overlapping the block), all
+                       of them, not only those sampled with --maxpairs
+    orphans            reads whose mate does not overlap the block
+    multi_read_groups  groups of more than two reads with the same name
+    skipped_pairs      pairs not decoded because of the pre-filter
+    variants           distinct variants found in the block
+    kept_variants      variants written to the kept output
+    binned_variants    variants written to the binned output
+
+and the times, in seconds, are:
+
+    fetch_seconds      retrieving the reads of the block from the bam file
+                       (for the sweep engine, the time spent streaming
+                       reads since the previous block was finished,
+                       and not measured for a stream on standard input)
+    pairing_seconds    grouping reads into pairs and tallying the variants
+    decoding_seconds   extracting the variants from the reads of each pair
+    output_seconds     writing the kept and binned variants
+
+The metrics of a run can be written to a sidecar file in JSON format, or in
+the Prometheus text exposition format (for the node exporter's textfile
+collector).
+'''
+
+import json
+
+count_metrics = [
+    'reads', 'overlapping_reads', 'pairs', 'orphans', 'multi_read_groups',
+    'skipped_pairs', 'variants', 'kept_variants', 'binned_variants']
+time_metrics = [
+    'fetch_seconds', 'pairing_seconds', 'decoding_seconds', 'output_seconds']
+metric_names = count_metrics + time_metrics
+
+prometheus_help = {
+    'reads': 'Reads intersecting the blocks.',
+    'overlapping_reads': 'Reads sufficiently overlapping the blocks.',
+    'pairs': 'Read pairs overlapping the blocks.',
+    'orphans': 'Reads whose mate does not overlap the block.',
+    'multi_read_groups': 'Groups of more than two reads with the same name.',
+    'skipped_pairs': 'Read pairs not decoded because of the pre-filter.',
+    'variants': 'Distinct variants found in the blocks.',
+    'kept_variants': 'Variants written to the kept output.',
+    'binned_variants': 'Variants written to the binned output.',
+    'fetch_seconds': 'Time spent retrieving reads from the bam file.',
+    'pairing_seconds': 'Time spent pairing reads and tallying variants.',
+    'decoding_seconds': 'Time spent extracting variants from reads.',
+    'output_seconds': 'Time spent writing variants.',
+}
+
+def new_block_metrics():
+    metrics = dict((name, 0) for name in count_metrics)
+    metrics.update((name, 0.0) for name in time_metrics)
+    return metrics
+
+def add_metrics(totals, metrics):
+    for name in metric_names:
+        totals[name] += metrics[name]
+
+class SampleMetrics(object):
+    '''The metrics of all the blocks of one sample.'''
+    def __init__(self, sample, bam_filename):
+        self.sample = sample
+        self.bam_filename = bam_filename
+        self.blocks = []
+        self.totals = new_block_metrics()
+    def add_block(self, chr, start, end, metrics):
+        self.blocks.append((chr, start, end, metrics))
+        add_metrics(self.totals, metrics)
+    def as_dict(self):
+        blocks = []
+        for chr, start, end, metrics in self.blocks:
+            block = {'chr': chr, 'start': start, 'end': end}
+            block.update(metrics)
+            blocks.append(block)
+        return {'sample': self.sample, 'bam': self.bam_filename,
+                'totals': self.totals, 'blocks': blocks}
+
+def write_json(metrics_file, samples):
+    totals = new_block_metrics()
+    for sample in samples:
+        add_metrics(totals, sample.totals)
+    json.dump({'totals': totals, 'samples': [sample.as_dict() for sample in samples]},
+              metrics_file, indent=1, sort_keys=True)
+    metrics_file.write('\n')
+
+def prometheus_labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+def write_prometheus(metrics_file, samples):
+    for name in metric_names:
+        sample_metric = 'rover_' + name + '_total'
+        metrics_file.write('# HELP {} {}\n'.format(sample_metric, prometheus_help[name]))
+        metrics_file.write('# TYPE {} counter\n'.format(sample_metric))
+        for sample in samples:
+            metrics_file.write('{}{{{}}} {}\n'.format(sample_metric,
+                prometheus_labels([('sample', sample.sample)]), sample.totals[name]))
+        block_metric = 'rover_block_' + name + '_total'
+        metrics_file.write('# HELP {} {}\n'.format(block_metric, prometheus_help[name]))
+        metrics_file.write('# TYPE {} counter\n'.format(block_metric))
+        for sample in samples:
+            for chr, start, end, metrics in sample.blocks:
+                labels = [('sample', sample.sample), ('chr', chr), ('start', start), ('end', end)]
+                metrics_file.write('{}{{{}}} {}\n'.format(block_metric,
+                    prometheus_labels(labels), metrics[name]))
+
+def write_metrics(filename, format, samples):
+    '''Write the metrics of each sample (a list of SampleMetrics) to filename in
+    the given format, either 'json' or 'prometheus'.'''
+    with open(filename, 'w') as metrics_file:
+        if format == 'prometheus':
+            write_prometheus(metrics_file, samples)
+        else:
+            write_json(metrics_file, samples)
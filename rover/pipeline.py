@@ -0,0 +1,137 @@
+'''
+Background threads which overlap reading and writing with the work of
+pairing reads and decoding variants.
+
+prefetched runs an iterator, such as the one which fetches the reads of
+each block from a bam file, in a producer thread, keeping a bounded number
+of its items ready for the consumer. htslib releases the global interpreter
+lock while it reads and decompresses the bam file, so the next blocks are
+read while the current one is decoded, which hides the latency of each
+fetch on slow (network) filesystems.
+
+BackgroundWriter collects the text written to a file into large chunks,
+which a writer thread writes to the file, so that the processing thread
+does not wait for the disk.
+'''
+
+import sys
+from threading import (Thread, Event)
+from Queue import (Queue, Empty)
+
+# text collected by a BackgroundWriter before it is handed to the writer thread
+write_chunk_size = 1 << 20
+# chunks waiting to be written before BackgroundWriter.write blocks
+max_pending_chunks = 8
+
+class ThreadFailed(object):
+    '''An exception raised in a background thread, to be raised again in
+    the thread which consumes its results.'''
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+    def reraise(self):
+        exc_type, exc_value, exc_traceback = self.exc_info
+        raise exc_type, exc_value, exc_traceback
+
+# marks the end of the items of a queue
+end_of_items = object()
+# how often a consumer which stops early checks that the producer has finished
+stop_poll_seconds = 0.05
+
+def prefetched(items, size):
+    '''Iterate over items in a background thread, keeping up to size items
+    ready ahead of the consumer. Exceptions in the background thread are
+    raised again in the consumer.
+
+    The producer has always finished when the iteration ends, even if the
+    consumer stops early, by raising an exception or closing the generator,
+    so the resources which items depends on (such as an open bam file) can
+    be released straight afterwards. Consumers which may stop early should
+    close the generator (with contextlib.closing) rather than rely on it
+    being garbage collected.'''
+    queue = Queue(maxsize=size)
+    stop = Event()
+
+    def produce():
+        try:
+            for item in items:
+                queue.put(item)
+                # checked between items, as the consumer may have stopped
+                if stop.is_set():
+                    return
+        except:
+            queue.put(ThreadFailed(sys.exc_info()))
+        else:
+            queue.put(end_of_items)
+        finally:
+            # release what items holds in this thread, not when it is collected
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    producer = Thread(target=produce, name='prefetch')
+    # do not keep the program alive if the consumer is killed
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end_of_items:
+                break
+            if isinstance(item, ThreadFailed):
+                item.reraise()
+            yield item
+    finally:
+        stop.set()
+        # take whatever the producer puts, so that it is never blocked on
+        # a full queue, until it notices the stop and finishes
+        while producer.is_alive():
+            try:
+                queue.get(timeout=stop_poll_seconds)
+            except Empty:
+                pass
+        producer.join()
+
+class BackgroundWriter(object):
+    '''A file-like object which writes to file in a background thread.
+    close must be called to write the remaining text; it does not close
+    file itself.'''
+    def __init__(self, file):
+        self.file = file
+        self.chunk = []
+        self.chunk_size = 0
+        self.queue = Queue(maxsize=max_pending_chunks)
+        self.failure = None
+        self.thread = Thread(target=self.write_chunks, name='writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, text):
+        self.chunk.append(text)
+        self.chunk_size += len(text)
+        if self.chunk_size >= write_chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            self.queue.put(''.join(self.chunk))
+            self.chunk = []
+            self.chunk_size = 0
+
+    def write_chunks(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is end_of_items:
+                break
+            if self.failure is None:
+                try:
+                    self.file.write(chunk)
+                except:
+                    # keep taking chunks, so that write does not block forever
+                    self.failure = ThreadFailed(sys.exc_info())
+
+    def close(self):
+        self.flush()
+        self.queue.put(end_of_items)
+        self.thread.join()
+        if self.failure is not None:
+            self.failure.reraise()
@@ -0,0 +1,153 @@
+'''
+A compiled index of the primer blocks, which is read once per run instead
+of parsing the primer TSV file, and which answers overlap queries.
+
+The index is a NumPy structured array with a row for each block:
+
+    chr    the chromosome name
+    start  the 1 based start of the block
+    end    the 1 based (inclusive) end of the block
+    block  the number of the block (from 0) in the order of the primer file
+
+sorted by chromosome, start and end. It is saved in the NumPy .npy format,
+so it can be memory mapped rather than read, and shared through the page
+cache by all the processes of a run (and by concurrent runs). The blocks
+are checked when the index is built, so a malformed primer file is
+reported with its line number before any bam file is read.
+
+An index is built from a primer TSV file with "rover index", or from the
+output of the primer design tool with "get_primer_blocks.py --index".
+Wherever rover takes a primer file, it accepts an index instead.
+'''
+
+import os
+import csv
+from threading import Lock
+import numpy as np
+
+# the first bytes of every .npy file
+npy_magic = '\x93NUMPY'
+
+def block_table(blocks):
+    '''Make the sorted table of an index from a list of (chr, start, end).'''
+    chr_size = max([len(chr) for chr, _start, _end in blocks] + [1])
+    dtype = [('chr', 'S{}'.format(chr_size)), ('start', '<i8'), ('end', '<i8'), ('block', '<i8')]
+    table = np.array([(chr, start, end, block) for block, (chr, start, end) in enumerate(blocks)],
+                     dtype=dtype)
+    table.sort(order=['chr', 'start', 'end', 'block'])
+    return table
+
+class PrimerIndex(object):
+    '''The primer blocks of a run, in a table made by block_table.'''
+    def __init__(self, table):
+        self.table = table
+        chrs = table['chr']
+        starts = table['start']
+        ends = table['end']
+        # the rows of each chromosome, its starts, and its largest block,
+        # for overlap queries
+        self.chromosomes = {}
+        first_blocks = []
+        # the table is sorted by chromosome, so the first row of each
+        # chromosome is where the next one ends
+        names, first_rows = np.unique(chrs, return_index=True)
+        bounds = first_rows.tolist() + [len(table)]
+        for name_index, name in enumerate(names.tolist()):
+            row_start, row_end = bounds[name_index], bounds[name_index + 1]
+            chr_starts = np.asarray(starts[row_start:row_end])
+            chr_sizes = np.asarray(ends[row_start:row_end]) - chr_starts
+            self.chromosomes[name] = (row_start, row_end, chr_starts, int(chr_sizes.max()))
+            first_blocks.append((int(table['block'][row_start:row_end].min()), name))
+        # in order of first appearance in the primer file
+        self.contigs = [name for _block, name in sorted(first_blocks)]
+
+    def __len__(self):
+        return len(self.table)
+
+    def blocks(self):
+        '''The (chr, start, end) of each block, in the order of the primer file.'''
+        order = np.argsort(self.table['block'], kind='mergesort')
+        rows = self.table[order]
+        return zip(rows['chr'].tolist(), rows['start'].tolist(), rows['end'].tolist())
+
+    def overlapping(self, chr, start, end):
+        '''The numbers of the blocks which overlap the region from start to
+        end (1 based, inclusive) of a chromosome, in increasing order.'''
+        chromosome = self.chromosomes.get(chr)
+        if chromosome is None:
+            return []
+        row_start, row_end, starts, max_size = chromosome
+        # a block which starts before start - max_size ends before start
+        first = row_start + np.searchsorted(starts, start - max_size, side='left')
+        last = row_start + np.searchsorted(starts, end, side='right')
+        rows = self.table[first:last]
+        return sorted(rows['block'][rows['end'] >= start].tolist())
+
+    def missing_contigs(self, references):
+        '''The chromosomes of the blocks which are not in references (the
+        chromosome names in the header of a bam file).'''
+        references = set(references)
+        return [chr for chr in self.contigs if chr not in references]
+
+    def save(self, filename):
+        with open(filename, 'wb') as file:
+            np.save(file, self.table)
+
+def read_primer_tsv(filename):
+    '''The (chr, start, end) of each block in a primer TSV file. Extra
+    columns are ignored. Raises ValueError for a malformed line.'''
+    blocks = []
+    with open(filename) as primers:
+        for line_number, row in enumerate(csv.reader(primers, delimiter='\t'), 1):
+            if not row:
+                continue
+            if len(row) < 3:
+                raise ValueError('{} line {}: expected chr, start and end, found {}'.format(
+                    filename, line_number, '\t'.join(row)))
+            chr, start, end = row[:3]
+            try:
+                start, end = int(start), int(end)
+            except ValueError:
+                raise ValueError('{} line {}: start and end must be integers, found {} and {}'.format(
+                    filename, line_number, start, end))
+            if not 1 <= start <= end:
+                raise ValueError('{} line {}: the block {} {} {} is empty or starts before 1'.format(
+                    filename, line_number, chr, start, end))
+            blocks.append((chr, start, end))
+    return blocks
+
+def is_primer_index(filename):
+    with open(filename, 'rb') as file:
+        return file.read(len(npy_magic)) == npy_magic
+
+def load_primer_index(filename):
+    '''Load a compiled primer index (memory mapped), or build one from a
+    primer TSV file.'''
+    if is_primer_index(filename):
+        return PrimerIndex(np.load(filename, mmap_mode='r'))
+    return PrimerIndex(block_table(read_primer_tsv(filename)))
+
+class PrimerIndexCache(object):
+    '''The primer indexes of the primer files loaded so far, for a long
+    running process (rover serve). A file is loaded again if its size or
+    modification time has changed.'''
+    def __init__(self):
+        # absolute file name -> ((size, modification time), PrimerIndex)
+        self.indexes = {}
+        self.lock = Lock()
+
+    def load(self, filename):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        identity = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            cached = self.indexes.get(filename)
+            if cached is not None and cached[0] == identity:
+                return cached[1]
+        primer_index = load_primer_index(filename)
+        with self.lock:
+            self.indexes[filename] = (identity, primer_index)
+        return primer_index
+
+    def __len__(self):
+        return len(self.indexes)
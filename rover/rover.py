@@ -1,36 +1,103 @@
 #!/usr/bin/env python
 
-from argparse import (ArgumentParser, FileType)
+from argparse import (ArgumentParser, ArgumentTypeError, FileType)
 import logging
 import sys
 import pysam
+import numpy as np
 import re
 import os
 from operator import itemgetter
-import csv
+from bisect import (bisect_left, bisect_right)
+from heapq import (heappush, heappop, heapreplace, nlargest)
+import time
+import math
+import signal
+import hashlib
+from struct import unpack
+import cProfile
 from version import rover_version
-from itertools import (izip, chain, repeat)
+from metrics import (new_block_metrics, add_metrics, SampleMetrics, write_metrics)
+from vcf import VcfOutput
+from matrix import MatrixOutput
+from tally import (TallyStore, tally_format, tally_key, file_digest, load_tally)
+from pipeline import (prefetched, BackgroundWriter)
+from primers import (PrimerIndex, PrimerIndexCache, block_table, read_primer_tsv, load_primer_index)
+from shard import (parse_shard, shard_filename, shard_items, shard_range, save_shard, load_shards)
+from server import (JobQueue, make_server)
+from itertools import (imap, izip)
+from array import array
+from functools import partial
+from contextlib import closing
+from multiprocessing import (Pool, TimeoutError)
 
 # proportion of block which must be overlapped by read 
 default_minimum_read_overlap_block = 0.9
 default_proportion_threshold = 0.05
 default_absolute_threshold = 2
+default_jobs = 1
+default_threads = 1
+default_prefetch = 0
+default_engine = 'fetch'
+default_metrics_format = 'json'
+default_shard_by = 'samples'
+default_seed = 0
+default_serve_port = 8770
+default_serve_concurrency = 2
+default_serve_queue = 100
+default_serve_timeout = 3600
+# number of finished jobs remembered by rover serve
+serve_finished_jobs = 1000
+# number of standard deviations either side of the proportion of a variant in
+# a sample of the pairs of a block within which its proportion in all the
+# pairs of the block is expected to lie, for --maxpairs
+recheck_z = 3.0
+# maximum number of distinct MD strings remembered by parse_md
+md_cache_size = 10000
+# maximum number of distinct read alignments and distinct pairs remembered
+# by each BlockTally
+read_memo_size = 100000
+pair_memo_size = 100000
+# number of chunks each sample's blocks are split into, per job, for --splitblocks
+chunks_per_job = 4
+# the bam file name which stands for a stream of reads on standard input
+stdin_filename = '-'
+default_stdin_sample = 'stdin'
 
-def parse_args():
+class InputError(Exception):
+    '''An error in the input of a run, which is raised rather than exiting
+    in code which runs in the worker processes: a pool never gets the
+    result of a worker which exits, and would wait for it for ever.'''
+
+class JobArgumentParser(ArgumentParser):
+    '''An ArgumentParser which raises ValueError for invalid arguments,
+    rather than exiting, for the jobs of rover serve.'''
+    def error(self, message):
+        raise ValueError(message)
+    def print_help(self, file=None):
+        pass
+    def exit(self, status=0, message=None):
+        raise ValueError(message or 'the arguments of a job cannot ask for help or the version')
+
+def parse_args(argv=None, parser_class=ArgumentParser):
     "Consider mapped reads to amplicon sites"
 
-    parser = ArgumentParser(description="Consider mapped reads to amplicon sites")
+    parser = parser_class(description="Consider mapped reads to amplicon sites")
     parser.add_argument(
     '--version', action='version', version='%(prog)s ' + rover_version)
     parser.add_argument(
         '--primers', type=str, required=True,
-        help='File name of primer coordinates in TSV format.')
+        help='File name of primer coordinates in TSV format, or of a primer index '
+             'made by rover index.')
     parser.add_argument(
         '--overlap', type=float, default=default_minimum_read_overlap_block,
         help='Minimum proportion of block which must be overlapped by a read. '
              'Defaults to {}.'.format(default_minimum_read_overlap_block))
     parser.add_argument(
-        'bams', nargs='+', type=str, help='bam files containing mapped reads')
+        'bams', nargs='+', type=str,
+        help='bam (or cram or sam) files containing mapped reads. A file name of '
+             '- reads a stream of reads from standard input, in which the reads '
+             'with the same name are next to each other.')
     parser.add_argument( '--log', metavar='FILE', type=str,
         help='Log progress in FILENAME, defaults to stdout.')
     parser.add_argument('--out', metavar='FILE', type=str,
@@ -49,15 +116,280 @@ def parse_args():
     parser.add_argument('--coverdir',
         required=False,
         help='Directory to write coverage files, defaults to current working directory.')
-    return parser.parse_args() 
+    parser.add_argument('--jobs', metavar='N', type=int,
+        default=default_jobs,
+        help='Number of worker processes used to process the bam files in parallel. '
+             'Defaults to {}.'.format(default_jobs))
+    parser.add_argument('--splitblocks', action='store_true', default=False,
+        help='Split the blocks of each bam file across the --jobs worker processes, '
+             'rather than processing each bam file in a single worker.')
+    parser.add_argument('--engine', choices=['fetch', 'sweep'],
+        default=default_engine,
+        help='How reads are retrieved from the bam files: fetch the reads of '
+             'each block separately, or sweep over each chromosome once. '
+             'Defaults to {}.'.format(default_engine))
+    parser.add_argument('--threads', metavar='N', type=int,
+        default=default_threads,
+        help='Number of threads htslib uses to decompress each bam file. '
+             'Defaults to {}.'.format(default_threads))
+    parser.add_argument('--prefetch', metavar='N', type=int,
+        default=default_prefetch,
+        help='Read the reads of up to N blocks ahead in a background thread while '
+             'the current block is processed, and write the variants in another '
+             'background thread. Defaults to {} (no background threads).'.format(default_prefetch))
+    parser.add_argument('--streampairs', action='store_true', default=False,
+        help='Pair the reads of each block as they are read from the bam file, '
+             'keeping only the reads whose mate has not arrived yet, rather than '
+             'collecting all the reads of the block before pairing them.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+        help='Log the progress of every block and every read without a pair.')
+    parser.add_argument('--metrics', metavar='FILE', type=str,
+        help='Write counts and timings for every sample and block to FILE.')
+    parser.add_argument('--metricsformat', choices=['json', 'prometheus'],
+        default=default_metrics_format,
+        help='Format of the --metrics file: JSON, or the Prometheus text format. '
+             'Defaults to {}.'.format(default_metrics_format))
+    parser.add_argument('--profile', metavar='FILE', type=str,
+        help='Profile the processing of each bam file with cProfile, and save the '
+             'statistics to FILE.SAMPLE (FILE.SAMPLE.N for each chunk with --splitblocks).')
+    parser.add_argument('--vcf', action='store_true', default=False,
+        help='Also write the kept and binned variants of all samples as sorted, '
+             'bgzip compressed and tabix indexed VCF files OUT.vcf.gz and '
+             'OUT.binned.vcf.gz.')
+    parser.add_argument('--matrix', action='store_true', default=False,
+        help='Also write the pair counts of the variants of all samples as a sparse '
+             'variant by sample matrix in OUT.matrix.npz, with the variants in '
+             'OUT.matrix.variants.tsv and the samples in OUT.matrix.samples.tsv.')
+    parser.add_argument('--reference', metavar='FASTA', type=str,
+        help='Reference genome in FASTA format (indexed with samtools faidx), '
+             'used to decode cram files and for the reference base before '
+             'insertions and deletions in VCF output.')
+    parser.add_argument('--stdinsample', metavar='NAME', type=str,
+        default=default_stdin_sample,
+        help='Sample name of the reads read from standard input (-). '
+             'Defaults to {}.'.format(default_stdin_sample))
+    parser.add_argument('--depth', action='store_true', default=False,
+        help='Write the number of read pairs covering each position of each block '
+             'to SAMPLE.depth.npy, with an index of the blocks in SAMPLE.depth.index, '
+             'in the coverage directory.')
+    parser.add_argument('--positiondepth', action='store_true', default=False,
+        help='Compute the proportion of each variant out of the read pairs covering '
+             'its position, rather than all the read pairs in its block.')
+    parser.add_argument('--tallydir', metavar='DIR', type=str,
+        help='Save the variant tallies of each sample in DIR, for rover recall, and '
+             'reuse the saved tallies of samples which have not changed.')
+    parser.add_argument('--maxpairs', metavar='N', type=max_pairs_argument,
+        help='Tally the variants of at most N read pairs of each block, chosen at '
+             'random, and write the variants whose keep or bin decision could be '
+             'different for all the pairs of their block to OUT.recheck. '
+             'Defaults to all the read pairs.')
+    parser.add_argument('--seed', metavar='N', type=int,
+        default=default_seed,
+        help='Seed of the random choice of read pairs for --maxpairs. '
+             'Defaults to {}.'.format(default_seed))
+    parser.add_argument('--shard', metavar='I/N', type=shard_argument,
+        help='Process only shard I of N of the work, and save its partial result '
+             'to OUT.shard-I-of-N.json.gz for rover merge.')
+    parser.add_argument('--shardby', choices=['samples', 'blocks'],
+        default=default_shard_by,
+        help='Split the work into shards by sample (every Nth bam file) or by '
+             'block (the Ith of N runs of blocks of every bam file). '
+             'Defaults to {}.'.format(default_shard_by))
+    return parser.parse_args(argv)
+
+def max_pairs_argument(text):
+    try:
+        max_pairs = int(text)
+    except ValueError:
+        raise ArgumentTypeError('invalid int value: {}'.format(text))
+    if max_pairs < 1:
+        raise ArgumentTypeError('must be at least 1, not {}'.format(max_pairs))
+    return max_pairs
+
+def shard_argument(text):
+    try:
+        return parse_shard(text)
+    except ValueError as error:
+        raise ArgumentTypeError(str(error))
+
+def parse_recall_args(argv=None):
+    "Call variants again from saved tallies"
+
+    parser = ArgumentParser(prog='rover recall',
+        description="Call variants again from the tallies saved by rover --tallydir, "
+                    "without reading the bam files")
+    parser.add_argument(
+    '--version', action='version', version='%(prog)s ' + rover_version)
+    parser.add_argument(
+        'tallies', nargs='+', type=str,
+        help='Tally files (SAMPLE.DIGEST.tally.json.gz) saved by rover --tallydir.')
+    parser.add_argument( '--log', metavar='FILE', type=str,
+        help='Log progress in FILENAME, defaults to stdout.')
+    parser.add_argument('--out', metavar='FILE', type=str,
+        required=True, help='Name of output file containing called variants.')
+    parser.add_argument('--proportionthresh', metavar='N', type=float,
+        default=default_proportion_threshold,
+        help='Keep variants which appear in this proportion of the read pairs for '
+             'a given target region, and bin otherwise. '
+             'Defaults to {}.'.format(default_proportion_threshold))
+    parser.add_argument('--absthresh', metavar='N', type=int,
+        default=default_absolute_threshold,
+        help='Only keep variants which appear in at least this many read pairs. '
+             'Defaults to {}.'.format(default_absolute_threshold))
+    parser.add_argument('--coverdir',
+        required=False,
+        help='Directory to write coverage files, defaults to current working directory.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+        help='Log more detail.')
+    parser.add_argument('--vcf', action='store_true', default=False,
+        help='Also write the kept and binned variants of all samples as sorted, '
+             'bgzip compressed and tabix indexed VCF files OUT.vcf.gz and '
+             'OUT.binned.vcf.gz.')
+    parser.add_argument('--matrix', action='store_true', default=False,
+        help='Also write the pair counts of the variants of all samples as a sparse '
+             'variant by sample matrix in OUT.matrix.npz, with the variants in '
+             'OUT.matrix.variants.tsv and the samples in OUT.matrix.samples.tsv.')
+    parser.add_argument('--reference', metavar='FASTA', type=str,
+        help='Reference genome in FASTA format (indexed with samtools faidx), '
+             'used for the reference base before insertions and deletions in '
+             'VCF output.')
+    parser.add_argument('--depth', action='store_true', default=False,
+        help='Write the number of read pairs covering each position of each block '
+             'to SAMPLE.depth.npy, with an index of the blocks in SAMPLE.depth.index, '
+             'in the coverage directory. The tallies must have been saved with '
+             '--depth or --positiondepth.')
+    parser.add_argument('--positiondepth', action='store_true', default=False,
+        help='Compute the proportion of each variant out of the read pairs covering '
+             'its position, rather than all the read pairs in its block. The tallies '
+             'must have been saved with --depth or --positiondepth.')
+    parser.set_defaults(metrics=None, prefetch=0)
+    return parser.parse_args(argv)
+
+def parse_index_args(argv=None):
+    "Compile a primer file into a primer index"
+
+    parser = ArgumentParser(prog='rover index',
+        description="Check the blocks of a primer file and compile them into a primer "
+                    "index, which can be given to --primers instead of the primer file")
+    parser.add_argument(
+    '--version', action='version', version='%(prog)s ' + rover_version)
+    parser.add_argument('primers', type=str,
+        help='File name of primer coordinates in TSV format.')
+    parser.add_argument('index', type=str,
+        help='File name of the primer index, usually ending in .npy.')
+    return parser.parse_args(argv)
+
+def parse_serve_args(argv=None):
+    "Run rover jobs submitted over HTTP"
+
+    parser = ArgumentParser(prog='rover serve',
+        description="Run rover jobs submitted over HTTP on localhost or a Unix socket, "
+                    "keeping primer indexes and worker processes between jobs")
+    parser.add_argument(
+    '--version', action='version', version='%(prog)s ' + rover_version)
+    parser.add_argument('--port', metavar='N', type=int,
+        default=default_serve_port,
+        help='Port of localhost to listen on. Defaults to {}.'.format(default_serve_port))
+    parser.add_argument('--socket', metavar='FILE', type=str,
+        help='Listen on a Unix socket FILE instead of a port.')
+    parser.add_argument('--workers', metavar='N', type=int,
+        default=default_jobs,
+        help='Number of worker processes shared by all the jobs, which process '
+             'the bam files of the jobs in place of --jobs. '
+             'Defaults to {}.'.format(default_jobs))
+    parser.add_argument('--concurrency', metavar='N', type=int,
+        default=default_serve_concurrency,
+        help='Number of jobs which run at once. '
+             'Defaults to {}.'.format(default_serve_concurrency))
+    parser.add_argument('--queue', metavar='N', type=int,
+        default=default_serve_queue,
+        help='Number of jobs which can wait to run, beyond which new jobs are '
+             'refused. Defaults to {}.'.format(default_serve_queue))
+    parser.add_argument('--timeout', metavar='SECONDS', type=float,
+        default=default_serve_timeout,
+        help='Fail a job which waits longer than SECONDS for a worker to process '
+             'a chunk of blocks, such as one whose worker process died. '
+             'Defaults to {}.'.format(default_serve_timeout))
+    parser.add_argument( '--log', metavar='FILE', type=str,
+        help='Log progress in FILENAME, defaults to stdout.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+        help='Log the progress of every block and every read without a pair.')
+    return parser.parse_args(argv)
+
+def parse_merge_args(argv=None):
+    "Merge the partial results of a sharded run"
+
+    parser = ArgumentParser(prog='rover merge',
+        description="Merge the partial results of the shards of a run with rover --shard, "
+                    "and write the output of the whole run")
+    parser.add_argument(
+    '--version', action='version', version='%(prog)s ' + rover_version)
+    parser.add_argument(
+        'shards', nargs='+', type=str,
+        help='Shard files (OUT.shard-I-of-N.json.gz) of all the shards of the run, or '
+             'the file of any one shard, which stands for all of them.')
+    parser.add_argument( '--log', metavar='FILE', type=str,
+        help='Log progress in FILENAME, defaults to stdout.')
+    parser.add_argument('--out', metavar='FILE', type=str,
+        required=True, help='Name of output file containing called variants.')
+    parser.add_argument('--coverdir',
+        required=False,
+        help='Directory to write coverage files, defaults to current working directory.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+        help='Log more detail.')
+    parser.add_argument('--metrics', metavar='FILE', type=str,
+        help='Write counts and timings for every sample and block to FILE.')
+    parser.add_argument('--metricsformat', choices=['json', 'prometheus'],
+        default=default_metrics_format,
+        help='Format of the --metrics file: JSON, or the Prometheus text format. '
+             'Defaults to {}.'.format(default_metrics_format))
+    parser.add_argument('--vcf', action='store_true', default=False,
+        help='Also write the kept and binned variants of all samples as sorted, '
+             'bgzip compressed and tabix indexed VCF files OUT.vcf.gz and '
+             'OUT.binned.vcf.gz.')
+    parser.add_argument('--matrix', action='store_true', default=False,
+        help='Also write the pair counts of the variants of all samples as a sparse '
+             'variant by sample matrix in OUT.matrix.npz, with the variants in '
+             'OUT.matrix.variants.tsv and the samples in OUT.matrix.samples.tsv.')
+    parser.add_argument('--reference', metavar='FASTA', type=str,
+        help='Reference genome in FASTA format (indexed with samtools faidx), '
+             'used for the reference base before insertions and deletions in '
+             'VCF output.')
+    parser.set_defaults(prefetch=0)
+    return parser.parse_args(argv)
 
 
+def load_primers(primers_file, cache=None):
+    '''The PrimerIndex of a primer TSV file or a compiled primer index,
+    through a PrimerIndexCache if one is given.'''
+    try:
+        if cache is not None:
+            return cache.load(primers_file)
+        return load_primer_index(primers_file)
+    except ValueError as error:
+        exit('Invalid primer file: {}'.format(error))
+
 def get_block_coords(primers_file):
-    with open(primers_file) as primers:
-        return list(csv.reader(primers, delimiter='\t'))
+    '''The (chr, start, end) of each block in a primer file, in order, with
+    1 based integer coordinates.'''
+    return load_primers(primers_file).blocks()
+
+def check_contigs(args, primer_index, bam_filenames):
+    '''Check that the chromosomes of all the blocks are in the header of
+    every bam file before any work begins, rather than failing in the
+    middle of the run. The stream on standard input is not checked, since
+    its header is only read when it is processed.'''
+    for bam_filename in bam_filenames:
+        if bam_filename == stdin_filename:
+            continue
+        with open_alignments(args, bam_filename) as bam:
+            missing = primer_index.missing_contigs(bam.references)
+        if missing:
+            exit('Chromosomes of the primer blocks are not in bam file {}: {}'.format(
+                bam_filename, ', '.join(missing)))
 
 
-def lookup_reads(min_overlap, bam, chr, start_col, end_col):
+def lookup_reads(min_overlap, bam, chr, start_col, end_col, metrics=None):
     # arguments are in zero-based indices
     total_reads = 0
     overlapping_reads = 0
@@ -72,16 +404,132 @@ def lookup_reads(min_overlap, bam, chr, start_col, end_col):
                 read_pairs[read.qname] = [read]
             else:
                 read_pairs[read.qname].append(read)
-    logging.info("number of reads intersecting block: {}".format(total_reads))
-    logging.info("number of reads sufficiently overlapping block: {}".format(overlapping_reads))
+    if metrics is not None:
+        metrics['reads'] = total_reads
+        metrics['overlapping_reads'] = overlapping_reads
     return read_pairs
 
+class SweepBlock(object):
+    '''A block which is currently overlapped by the sweep over a chromosome,
+    along with the reads collected for it so far.'''
+    def __init__(self, start_col, end_col, block_index):
+        self.start_col = start_col
+        self.end_col = end_col
+        self.block_index = block_index
+        self.metrics = new_block_metrics()
+        self.read_pairs = {}
+        self.matcher = None
+
+def alignment_end(read):
+    '''The zero based position one past the last aligned base of a read. This
+    follows htslib, which treats reads without aligned bases as having length
+    one, so that the sweep engine selects exactly the reads fetch would.'''
+    aend = read.aend
+    if aend is None:
+        return read.pos + 1
+    return aend
+
+def sweep_reads(min_overlap, bam, chr, blocks, new_matcher=None):
+    '''Stream the reads of a chromosome once, and assign them to all of the
+    blocks they sufficiently overlap. blocks is a list of
+    (start_col, end_col, block_index) in zero based coordinates. Yields
+    (block_index, read_pairs, metrics) for each block, as soon as the sweep
+    has moved past the end of the block. The fetch time of each block is the
+    time spent streaming since the previous block was yielded.
+
+    If new_matcher is given, it is called with the block index and metrics
+    of each block when the sweep reaches the block, to make a PairMatcher
+    which is given the reads of the block instead of read_pairs, and which
+    is yielded in place of read_pairs.'''
+    blocks = sorted(blocks)
+    num_blocks = len(blocks)
+    region_start = blocks[0][0]
+    region_end = max(end_col for _start_col, end_col, _block_index in blocks)
+    next_block = 0
+    active = []
+    # smallest end coordinate of the active blocks
+    active_end = None
+    # when the sweep last resumed after yielding a block
+    resumed = [time.time()]
+
+    def retired(block):
+        block.metrics['fetch_seconds'] = time.time() - resumed[0]
+        if block.matcher is not None:
+            return block.block_index, block.matcher, block.metrics
+        return block.block_index, block.read_pairs, block.metrics
+
+    def activated(block_info):
+        block = SweepBlock(*block_info)
+        if new_matcher is not None:
+            block.matcher = new_matcher(block.block_index, block.metrics)
+        return block
+
+    for read in bam.fetch(chr, region_start, region_end + 1):
+        # reads arrive in coordinate order, so any block which ends before
+        # this read starts cannot be overlapped by any later read
+        if active_end is not None and active_end < read.pos:
+            still_active = []
+            for block in active:
+                if block.end_col < read.pos:
+                    yield retired(block)
+                    resumed[0] = time.time()
+                else:
+                    still_active.append(block)
+            active = still_active
+            active_end = min(block.end_col for block in active) if active else None
+        # activate the blocks which start at or before the end of this read
+        read_end = read.pos + read.rlen - 1
+        while next_block < num_blocks and blocks[next_block][0] <= read_end:
+            block = activated(blocks[next_block])
+            active.append(block)
+            if active_end is None or block.end_col < active_end:
+                active_end = block.end_col
+            next_block += 1
+        read_aend = alignment_end(read)
+        for block in active:
+            # the same test that fetch applies for the block region
+            if read.pos <= block.end_col and read_aend > block.start_col:
+                block.metrics['reads'] += 1
+                # only keep reads which overlap with the block region by a certain proportion
+                overlap = proportion_overlap(block.start_col, block.end_col, read)
+                if overlap > min_overlap:
+                    block.metrics['overlapping_reads'] += 1
+                    if block.matcher is not None:
+                        block.matcher.add(read)
+                    elif read.qname not in block.read_pairs:
+                        block.read_pairs[read.qname] = [read]
+                    else:
+                        block.read_pairs[read.qname].append(read)
+    for block in active:
+        yield retired(block)
+        resumed[0] = time.time()
+    # blocks which start after the last read
+    while next_block < num_blocks:
+        yield retired(activated(blocks[next_block]))
+        resumed[0] = time.time()
+        next_block += 1
+
 def get_MD(read):
     for tag, val in read.tags:
         if tag == 'MD':
             return val
     return None
 
+def may_have_variants(md, cigar):
+    '''A cheap test of whether read_variants could find any variants in a
+    read, without decoding it. A read whose MD tag contains no mismatches
+    or deletions (only a match length) and whose cigar contains no
+    insertions matches the reference, and read_variants finds nothing in
+    a read without an MD tag.'''
+    if not md:
+        return False
+    if md.isdigit():
+        for cigar_code, _cigar_extent in cigar:
+            if cigar_code == 1:
+                return True
+        return False
+    return True
+
 #M   BAM_CMATCH  0
 #I   BAM_CINS    1
 #D   BAM_CDEL    2
@@ -93,183 +541,184 @@ def get_MD(read):
 #X   BAM_CDIFF   8
 
 # find all the variants in a single read (SNVs, Insertions, Deletions)
-def read_variants(args, name, chr, pos, aligned_bases, cigar, md):
-    cigar_orig = cigar
-    md_orig = md
+#
+# Each variant is a tuple (pos, ref, alt) of its 1 based position and its
+# reference and alternative alleles as DNA strings, where '-' stands for
+# the missing allele of an insertion or deletion:
+#
+#    SNV:       (pos, ref_base, seq_base)
+#    Insertion: (pos, '-', inserted_bases)
+#    Deletion:  (pos, deleted_bases, '-')
+#
+# The chromosome is not part of the variant; it is implied by the block
+# the read belongs to. Tuples of (interned) strings are cheap to hash and
+# compare, which matters because variants are intersected for every pair.
+#
+# The work is split in two: variant_sites walks the cigar and MD of the
+# read, which depend only on its alignment, and site_variants reads the
+# bases and quality scores at the sites it found. Amplicon reads share a
+# small number of distinct alignments, so BlockTally walks each of them
+# only once per block.
+def read_variants(args, name, pos, bases, qualities, cigar, md):
+    try:
+        sites = variant_sites(pos, cigar, md)
+    except InputError as error:
+        raise InputError("read {}: {}".format(name, error))
+    return site_variants(sites, bases, qualities, args.qualthresh)
+
+# the kinds of variant sites
+site_mismatch = 0
+site_insertion = 1
+site_deletion = 2
+
+# The cigar and MD are walked with an index into each, along with the
+# length of the current cigar operation and MD match which remains to be
+# walked, so neither list (nor the MD tokens) is modified.
+def variant_sites(pos, cigar, md):
+    '''The places in a read where read_variants can find a variant, given
+    the 1 based position, cigar and parsed MD of the read. Each site is one of
+
+        (site_mismatch, pos, ref_base, seq_index)
+        (site_insertion, pos, seq_index, seq_end)
+        (site_deletion, pos, ref_bases)
+
+    where seq_index (to seq_end) are the indices of the read bases of a
+    mismatch or insertion. Raises InputError if the cigar and MD do not
+    agree, or the cigar has an unsupported operation.'''
     seq_index = 0
     result = []
+    num_cigar = len(cigar)
+    num_md = len(md)
+    cigar_index = 0
+    md_index = 0
+    if num_cigar > 0:
+        cigar_extent = cigar[0][1]
+    if num_md > 0 and isinstance(md[0], MD_match):
+        md_remaining = md[0].size
 
-    while cigar and md:
-        cigar_code, cigar_segment_extent = cigar[0]
-        next_md = md[0]
+    while cigar_index < num_cigar and md_index < num_md:
+        cigar_code = cigar[cigar_index][0]
+        next_md = md[md_index]
 
         if cigar_code == 0:
             # Cigar Match
             if isinstance(next_md, MD_match):
-                # MD match 
-                if next_md.size >= cigar_segment_extent:
-                    next_md.size -= cigar_segment_extent
-                    if next_md.size == 0:
-                        md = md[1:]
-                    cigar = cigar[1:]
-                    pos += cigar_segment_extent
-                    seq_index += cigar_segment_extent
+                # MD match
+                if md_remaining >= cigar_extent:
+                    md_remaining -= cigar_extent
+                    pos += cigar_extent
+                    seq_index += cigar_extent
+                    if md_remaining == 0:
+                        md_index += 1
+                        if md_index < num_md and isinstance(md[md_index], MD_match):
+                            md_remaining = md[md_index].size
+                    cigar_index += 1
+                    if cigar_index < num_cigar:
+                        cigar_extent = cigar[cigar_index][1]
                 else:
-                    # next_md.size < cigar_segment_extent
-                    cigar = [(cigar_code, cigar_segment_extent - next_md.size)] + cigar[1:]
-                    md = md[1:]
-                    pos += next_md.size
-                    seq_index += next_md.size
+                    # md_remaining < cigar_extent
+                    cigar_extent -= md_remaining
+                    pos += md_remaining
+                    seq_index += md_remaining
+                    md_index += 1
+                    if md_index < num_md and isinstance(md[md_index], MD_match):
+                        md_remaining = md[md_index].size
             elif isinstance(next_md, MD_mismatch):
-                 # MD mismatch
-                 seq_base_qual = aligned_bases[seq_index]
-                 # check if the read base is above the minimum quality score
-                 if (args.qualthresh is None) or (seq_base_qual.qual >= args.qualthresh):
-                     seq_base = seq_base_qual.base
-                     result.append(SNV(chr, pos, next_md.ref_base, seq_base))
-                 cigar = [(cigar_code, cigar_segment_extent - 1)] + cigar[1:]
-                 md = md[1:]
-                 pos += 1
-                 seq_index += 1
+                # MD mismatch
+                result.append((site_mismatch, pos, next_md.ref_base, seq_index))
+                cigar_extent -= 1
+                md_index += 1
+                if md_index < num_md and isinstance(md[md_index], MD_match):
+                    md_remaining = md[md_index].size
+                pos += 1
+                seq_index += 1
             elif isinstance(next_md, MD_deletion):
                 # MD deletion, should not happen in Cigar match
-                logging.info("MD del in cigar match {} {}".format(md_orig, cigar_orig))
-                exit()
+                raise InputError("a deletion in the MD of a cigar match")
             else:
-                logging.info("unexpected MD code {}".format(md_orig))
-                exit()
-        elif cigar_code == 1: 
+                raise InputError("unexpected MD code")
+        elif cigar_code == 1:
             # Insertion
-            seq_bases_quals = aligned_bases[seq_index:seq_index + cigar_segment_extent]
-            seq_bases = ''.join([b.base for b in seq_bases_quals])
-            # check that all the bases are above the minimum quality threshold
-            if (args.qualthresh is None) or all([b.qual >= args.qualthresh for b in seq_bases_quals]):
-                result.append(Insertion(chr, pos, seq_bases))
-            cigar = cigar[1:]
-            seq_index += cigar_segment_extent
+            seq_end = seq_index + cigar_extent
+            result.append((site_insertion, pos, seq_index, seq_end))
+            seq_index = seq_end
             # pos does not change
+            cigar_index += 1
+            if cigar_index < num_cigar:
+                cigar_extent = cigar[cigar_index][1]
         elif cigar_code == 2:
             # Deletion
             if isinstance(next_md, MD_deletion):
-                result.append(Deletion(chr, pos, next_md.ref_bases))
-                md = md[1:]
-                cigar = cigar[1:]
-                pos += cigar_segment_extent
+                result.append((site_deletion, pos, next_md.ref_bases))
+                md_index += 1
+                if md_index < num_md and isinstance(md[md_index], MD_match):
+                    md_remaining = md[md_index].size
+                pos += cigar_extent
                 # seq_index does not change
+                cigar_index += 1
+                if cigar_index < num_cigar:
+                    cigar_extent = cigar[cigar_index][1]
             else:
-                logging.info("Non del MD in Del Cigar".format(md_orig, cigar_orig))
-                exit()
+                raise InputError("no deletion in the MD of a cigar deletion")
+        elif cigar_code == 4:
+            # Soft clip, the bases are in the read but not aligned
+            seq_index += cigar_extent
+            # pos does not change
+            cigar_index += 1
+            if cigar_index < num_cigar:
+                cigar_extent = cigar[cigar_index][1]
+        elif cigar_code == 5:
+            # Hard clip, the bases are not in the read
+            cigar_index += 1
+            if cigar_index < num_cigar:
+                cigar_extent = cigar[cigar_index][1]
+        else:
+            raise InputError("unsupported cigar code {}".format(cigar_code))
+    return result
+
+def site_variants(sites, bases, qualities, qualthresh):
+    '''The variants at the sites of a read (see variant_sites), leaving out
+    mismatches and insertions with a base below the minimum quality score.'''
+    result = []
+    for site in sites:
+        kind = site[0]
+        if kind == site_mismatch:
+            _kind, pos, ref_base, seq_index = site
+            # check if the read base is above the minimum quality score
+            if (qualthresh is None) or (qualities[seq_index] >= qualthresh):
+                result.append((pos, ref_base, bases[seq_index]))
+        elif kind == site_insertion:
+            _kind, pos, seq_index, seq_end = site
+            # check that all the bases are above the minimum quality threshold
+            if (qualthresh is None) or (min(qualities[seq_index:seq_end]) >= qualthresh):
+                result.append((pos, '-', intern(bases[seq_index:seq_end])))
         else:
-            logging.info("unexpected cigar code {}".format(cigar_orig))
-            exit()
+            _kind, pos, ref_bases = site
+            result.append((pos, ref_bases, '-'))
     return result
 
 
-# SAM/BAM files store the quality score of a base as a byte (ascii character)
-# in "Qual plus 33 format". So we subtract off 33 from the ascii code
-# to get the actual score
+# pysam decodes the quality scores of a read (stored in SAM as ascii
+# characters in "Qual plus 33 format") into an array of phred scores,
+# one byte per base, so they are used as is.
 # See: http://samtools.sourceforge.net/SAMv1.pdf
-# ASCII codes 32 an above are the so-called printable characters, but 32
-# is a whitespace character, so SAM uses 33 and above.
-def ascii_to_phred(ascii):
-    return ord(ascii) - 33
-
 def make_base_seq(name, bases, qualities):
-    '''Take a list of DNA bases and a corresponding list of quality scores
-    and return a list of Base objects where the base and score are
-    paired together.'''
+    '''Take the DNA bases of a read and the corresponding array of quality
+    scores and return them as a pair, making sure there is a quality score
+    for every base.'''
     num_bases = len(bases)
-    num_qualities = len(qualities)
+    num_qualities = 0 if qualities is None else len(qualities)
     if num_bases <= num_qualities:
-        return [Base(b, ascii_to_phred(q)) for (b, q) in izip(bases, qualities)]
+        return bases, qualities
     else:
         logging.warning("In read {} fewer quality scores {} than bases {}"
             .format(name, num_qualities, num_bases))
         # we have fewer quality scores than bases
-        # pad the end with 0 scores (which is ord('!') - 33)
-        return [Base(b, ascii_to_phred(q))
-            for (b, q) in izip(bases, chain(qualities, repeat('!')))]
-
-# a DNA base paired with its quality score
-class Base(object):
-    def __init__(self, base, qual):
-        self.base = base # a string
-        self.qual = qual # an int
-    def as_tuple(self):
-        return (self.base, self.qual)
-    def __eq__(self, other):
-        return self.as_tuple() == other.as_tuple()
-    def __str__(self):
-        return str(self.as_tuple())
-    def __repr__(self):
-        return str(self)
-    def __hash__(self):
-        return hash(self.as_tuple)
-
-class SNV(object):
-    # bases are represented just as DNA strings
-    def __init__(self, chr, pos, ref_base, seq_base):
-        self.chr = chr
-        self.pos = pos
-        self.ref_base = ref_base
-        self.seq_base = seq_base 
-    def __str__(self):
-        return "S: {} {} {} {}".format(self.chr, self.pos, self.ref_base, self.seq_base)
-    def __repr__(self):
-        return str(self)
-    def as_tuple(self):
-        return (self.chr, self.pos, self.ref_base, self.seq_base)
-    def __hash__(self):
-        return hash(self.as_tuple())
-    def __eq__(self, other):
-        return self.as_tuple() == other.as_tuple()
-    def ref(self):
-        return self.ref_base
-    def alt(self):
-        return self.seq_base
-
-
-class Insertion(object):
-    # bases are represented just as DNA strings
-    def __init__(self, chr, pos, inserted_bases):
-        self.chr = chr
-        self.pos = pos
-        self.inserted_bases = inserted_bases
-    def __str__(self):
-        return "I: {} {} {}".format(self.chr, self.pos, self.inserted_bases)
-    def __repr__(self):
-        return str(self)
-    def as_tuple(self):
-        return (self.chr, self.pos, self.inserted_bases)
-    def __hash__(self):
-        return hash(self.as_tuple())
-    def __eq__(self, other):
-        return self.as_tuple() == other.as_tuple()
-    def ref(self):
-        return '-'
-    def alt(self):
-        return self.inserted_bases
-
-class Deletion(object):
-    # bases are represented just as DNA strings
-    def __init__(self, chr, pos, deleted_bases):
-        self.chr = chr
-        self.pos = pos
-        self.deleted_bases = deleted_bases
-    def __str__(self):
-        return "D: {} {} {}".format(self.chr, self.pos, self.deleted_bases)
-    def __repr__(self):
-        return str(self)
-    def as_tuple(self):
-        return (self.chr, self.pos, self.deleted_bases)
-    def __hash__(self):
-        return hash(self.as_tuple())
-    def __eq__(self, other):
-        return self.as_tuple() == other.as_tuple()
-    def ref(self):
-        return self.deleted_bases
-    def alt(self):
-        return '-'
+        # pad the end with 0 scores
+        padding = array('B', [0]) * (num_bases - num_qualities)
+        if qualities is None:
+            return bases, padding
+        return bases, qualities + padding
 
 class MD_match(object):
     def __init__(self, size):
@@ -295,38 +744,98 @@ class MD_deletion(object):
     def __repr__(self):
         return self.__str__()
 
-# [0-9]+(([A-Z]|\^[A-Z]+)[0-9]+)*
-def parse_md(md, result):
-    if md:
-        number_match = re.match('([0-9]+)(.*)', md)
-        if number_match is not None:
-            number_groups = number_match.groups()
-            number = int(number_groups[0])
-            md = number_groups[1]
-            return parse_md_snv(md, result + [MD_match(number)])
-    return result
+class LRUCache(object):
+    '''A dictionary which holds at most maxsize items, discarding the least
+    recently used item when it is full.
+
+    The items are kept in a circular doubly linked list, in order of use,
+    with each link being a list [previous, next, key, value]. In Python 2.7
+    OrderedDict is written in Python and moving an item to the end of it
+    costs more than parsing a short MD string, so it is not used here.'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.links = {}
+        # the root of the list, its next link is the least recently used
+        self.root = root = []
+        root[:] = [root, root, None, None]
+    def get(self, key):
+        link = self.links.get(key)
+        if link is None:
+            return None
+        previous, next, _key, value = link
+        # move the link to the end of the list
+        previous[1] = next
+        next[0] = previous
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+    def put(self, key, value):
+        if key in self.links:
+            # forget the old value, it is added again below
+            previous, next, _key, _value = self.links.pop(key)
+            previous[1] = next
+            next[0] = previous
+        elif len(self.links) >= self.maxsize:
+            root = self.root
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.links[oldest[2]]
+        root = self.root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self.links[key] = link
+    def __len__(self):
+        return len(self.links)
 
-def parse_md_snv(md, result):
-    if md:
-        snv_match = re.match('([A-Z])(.*)', md)
-        if snv_match is not None:
-            snv_groups = snv_match.groups()
-            ref_base = snv_groups[0]
-            md = snv_groups[1]
-            return parse_md(md, result + [MD_mismatch(ref_base)])
+# Amplicon reads share a small number of distinct MD strings, so most of
+# them are parsed only once.
+md_cache = LRUCache(md_cache_size)
+
+# A single MD token: a match length, a mismatched reference base, or the
+# reference bases of a deletion.
+md_token_regex = re.compile('([0-9]+)|([A-Z])|\^([A-Z]+)')
+
+# [0-9]+(([A-Z]|\^[A-Z]+)[0-9]+)*
+def tokenize_md(md):
+    '''Split an MD string into a list of MD_match, MD_mismatch and
+    MD_deletion objects. Match lengths alternate with mismatches and
+    deletions. Parsing stops at the first token which does not fit the
+    grammar above.'''
+    result = []
+    md_len = len(md)
+    md_index = 0
+    expect_number = True
+    while md_index < md_len:
+        token = md_token_regex.match(md, md_index)
+        if token is None:
+            break
+        number, ref_base, ref_bases = token.groups()
+        if expect_number:
+            if number is None:
+                break
+            result.append(MD_match(int(number)))
+        elif ref_base is not None:
+            result.append(MD_mismatch(ref_base))
+        elif ref_bases is not None:
+            result.append(MD_deletion(intern(ref_bases)))
         else:
-            return parse_md_del(md, result)
+            break
+        expect_number = not expect_number
+        md_index = token.end()
     return result
 
-def parse_md_del(md, result):
-    if md:
-        del_match = re.match('(\^[A-Z]+)(.*)', md)
-        if del_match is not None:
-            del_groups = del_match.groups()
-            ref_bases = del_groups[0][1:]
-            md = del_groups[1]
-            return parse_md(md, result + [MD_deletion(ref_bases)])
-    return result
+def parse_md(md):
+    if not md:
+        return ()
+    tokens = md_cache.get(md)
+    if tokens is None:
+        tokens = tuple(tokenize_md(md))
+        md_cache.put(md, tokens)
+    return tokens
 
 def proportion_overlap(block_start, block_end, read):
     '''Compute the proportion of the block that is overlapped by the read
@@ -357,107 +866,1181 @@ def proportion_overlap(block_start, block_end, read):
         block_size = block_end - block_start + 1
         return float(overlap_size) / block_size
 
-def write_variant(file, variant, sample):
+def write_variant(file, chr, variant, sample):
+    pos, ref, alt = variant
     file.write(
-        '\t'.join([variant.chr, str(variant.pos), str(variant.pos), variant.ref(),
-                   variant.alt(), "comments: " + sample]) + '\n')
+        '\t'.join([chr, str(pos), str(pos), ref, alt, "comments: " + sample]) + '\n')
 
-def process_blocks(args, kept_variants_file, binned_variants_file, bam, sample, block_coords):
-    coverage_info = []
-    for block_info in block_coords:
-        chr, start, end = block_info[:3]
-        start = int(start)
-        end = int(end)
-        logging.info("processing block chr: {}, start: {}, end: {}".format(chr, start, end))
-        # process all the reads in one block
-        block_vars = {}
-        num_pairs = 0
+class BlockResult(object):
+    '''The outcome of processing all the reads in one primer block of a sample:
+    the number of read pairs which overlapped the block and the number of those
+    pairs containing each variant. The variants are kept as a list of
+    (variant, count) pairs sorted by position, so the output does not depend
+    on the order in which the pairs were processed. metrics holds the counts
+    and timings of the block (see the metrics module). depth is None, or
+    (with --depth or --positiondepth) an array of the number of pairs covering
+    each position of the block, see pair_depth. With --maxpairs, num_pairs,
+    the variants and the depths are those of the sample of the pairs, and
+    total_pairs is the number of pairs in the block.'''
+    def __init__(self, chr, start, end, variants, num_pairs, metrics, depth=None):
+        self.chr = chr
+        self.start = start
+        self.end = end
+        self.variants = variants
+        self.num_pairs = num_pairs
+        self.metrics = metrics
+        self.depth = depth
+    def variant_depth(self, variant):
+        '''The number of read pairs the proportion of a variant is computed
+        from: the pairs covering its position if the depth of the block is
+        known, otherwise all the pairs in the block.'''
+        if self.depth is None:
+            return self.num_pairs
+        return int(self.depth[variant[0] - self.start])
+    @property
+    def total_pairs(self):
+        return self.metrics['pairs']
+
+def pair_span(read1, read2):
+    '''The 1 based start and (exclusive) end of the reference positions
+    covered by both reads of a pair, which are the only positions where a
+    variant can be seen in both reads. The span is empty (start >= end) if
+    the reads do not overlap.'''
+    start = max(read1.pos, read2.pos) + 1
+    end = min(alignment_end(read1), alignment_end(read2)) + 1
+    return start, end
+
+def pair_priority(seed, read_name):
+    '''The random priority of a read pair for --maxpairs, which is taken from
+    the seed and the name of the pair rather than drawn as the pairs arrive,
+    so the same pairs are chosen whichever way the reads are retrieved.'''
+    return unpack('<Q', hashlib.md5('{}\t{}'.format(seed, read_name)).digest()[:8])[0]
+
+def pair_depth(start, end, pair_starts, pair_ends):
+    '''The number of read pairs covering each position of the block from
+    start to end (1 based, inclusive), given the spans of the pairs. Rather
+    than counting the positions of each pair, each span adds one at its
+    (clipped) start and subtracts one at its end in a difference array, so
+    the depth is the cumulative sum of the differences.'''
+    size = end - start + 1
+    starts = np.clip(np.array(pair_starts, dtype=np.int64) - start, 0, size)
+    ends = np.clip(np.array(pair_ends, dtype=np.int64) - start, 0, size)
+    covered = starts < ends
+    differences = (np.bincount(starts[covered], minlength=size + 1) -
+                   np.bincount(ends[covered], minlength=size + 1))
+    return np.cumsum(differences[:size]).astype(np.uint32)
+
+class BlockTally(object):
+    '''The variants shared by both reads of each pair in one block, counted
+    one group of reads (the reads with the same name) at a time, so the
+    reads of a block can be gathered all at once (tally_block) or as they
+    stream past (stream_blocks).
+
+    The reads of an amplicon are highly redundant, so the work is shared
+    between reads and pairs which are the same. The variant sites of each
+    distinct alignment (position, cigar and MD) are found only once, and
+    each read only looks up the bases and quality scores at those sites.
+    The pairs are then counted by the variants of both of their reads, and
+    the variants shared by the reads of each distinct pair are tallied once,
+    weighted by the number of pairs. So that the memory used by a block
+    with many different reads stays bounded, the alignments are forgotten,
+    and the pairs counted so far are tallied, whenever there are too many
+    of them (read_memo_size and pair_memo_size).
+
+    With --maxpairs only a sample of the pairs of the block is tallied. It
+    is a reservoir of the --maxpairs pairs with the lowest priority (see
+    pair_priority) seen so far, kept in a heap, and the pairs in it are
+    only tallied when the result is made.'''
+    def __init__(self, args, chr, start, end, metrics):
+        self.args = args
+        self.qualthresh = args.qualthresh
+        self.max_pairs = args.maxpairs
+        self.seed = args.seed
+        self.chr = chr
+        self.start = start
+        self.end = end
+        self.metrics = metrics
+        self.verbose = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.with_depth = args.depth or args.positiondepth
+        # (pos, md, cigar) -> variant sites of the reads with that alignment
+        self.read_sites = {}
+        # (variants of one read, variants of the other) -> number of pairs
+        self.pair_counts = {}
+        self.distinct_pairs = 0
+        self.block_vars = {}
+        # heap of (-priority, read name, reads) of the pairs sampled so far
+        self.reservoir = []
+        self.num_pairs = 0
+        self.skipped_pairs = 0
+        self.orphans = 0
+        self.multi_read_groups = 0
+        self.pair_starts = []
+        self.pair_ends = []
+        # the spans of the pairs taken back by count_pair
+        self.retracted_starts = []
+        self.retracted_ends = []
+        self.decoding_seconds = 0.0
+        # time spent in add_group, including decoding
+        self.pairing_seconds = 0.0
+
+    def add_group(self, read_name, reads):
+        num_reads = len(reads)
+        if num_reads == 2:
+            self.num_pairs += 1
+            if self.max_pairs is None:
+                self.add_pair(reads[0], reads[1])
+            else:
+                self.sample_pair(read_name, reads)
+        elif num_reads == 1:
+            self.add_orphan(read_name)
+        else:
+            self.add_multi_read_group(read_name)
+
+    def add_pair(self, read1, read2):
+        self.count_pair(*self.pair_summary(read1, read2))
+
+    def pair_summary(self, read1, read2):
+        '''The signature of a pair (see pair_signature), and its span with
+        --depth or --positiondepth.'''
+        span = pair_span(read1, read2) if self.with_depth else None
+        decoding_start = time.time()
+        signature = self.pair_signature(read1, read2)
+        self.decoding_seconds += time.time() - decoding_start
+        return signature, span
+
+    def count_pair(self, signature, span, weight=1):
+        '''Count a pair given its signature and span, or take back a pair
+        counted before with a weight of -1.'''
+        if self.with_depth:
+            if weight > 0:
+                self.pair_starts.append(span[0])
+                self.pair_ends.append(span[1])
+            else:
+                self.retracted_starts.append(span[0])
+                self.retracted_ends.append(span[1])
+        if signature is None:
+            self.skipped_pairs += weight
+        elif signature:
+            pair_counts = self.pair_counts
+            pair_counts[signature] = pair_counts.get(signature, 0) + weight
+            if len(pair_counts) >= pair_memo_size:
+                self.tally_pairs()
+
+    def sample_pair(self, read_name, reads):
+        '''Add a pair to the reservoir if its priority is among the lowest
+        --maxpairs seen so far.'''
+        entry = (-pair_priority(self.seed, read_name), read_name, reads)
+        reservoir = self.reservoir
+        if len(reservoir) < self.max_pairs:
+            heappush(reservoir, entry)
+        elif entry > reservoir[0]:
+            heapreplace(reservoir, entry)
+
+    def read_variants(self, read, md, cigar):
+        '''The variants of a read, as a tuple.'''
+        pos = read.pos
+        key = (pos, md, tuple(cigar))
+        read_sites = self.read_sites
+        sites = read_sites.get(key)
+        if sites is None:
+            if len(read_sites) >= read_memo_size:
+                read_sites.clear()
+            try:
+                sites = read_sites[key] = variant_sites(pos + 1, cigar, parse_md(md))
+            except InputError as error:
+                raise InputError("read {} with cigar {} and MD {}: {}".format(
+                    read.qname, read.cigarstring, md, error))
+        if not sites:
+            return ()
+        bases, qualities = make_base_seq(read.qname, read.query_sequence, read.query_qualities)
+        return tuple(site_variants(sites, bases, qualities, self.qualthresh))
+
+    def pair_signature(self, read1, read2):
+        '''The variants of both reads of a pair, in a canonical order, or ()
+        if either read has none, or None if the pair was skipped by the
+        pre-filter.'''
+        # a pair only contributes variants which are in both reads, so
+        # skip it without decoding if either read cannot have any
+        read1_md = get_MD(read1)
+        read1_cigar = read1.cigar
+        if not may_have_variants(read1_md, read1_cigar):
+            return None
+        read2_md = get_MD(read2)
+        read2_cigar = read2.cigar
+        if not may_have_variants(read2_md, read2_cigar):
+            return None
+        variants1 = self.read_variants(read1, read1_md, read1_cigar)
+        if not variants1:
+            return ()
+        variants2 = self.read_variants(read2, read2_md, read2_cigar)
+        if not variants2:
+            return ()
+        if variants2 < variants1:
+            return (variants2, variants1)
+        return (variants1, variants2)
+
+    def read_summary(self, read):
+        '''What the pairs of a read need to know of it, without the read: its
+        variants (None if it is skipped by the pre-filter), and the 0 based
+        start and end of its alignment.'''
+        decoding_start = time.time()
+        md = get_MD(read)
+        cigar = read.cigar
+        variants = None
+        if may_have_variants(md, cigar):
+            variants = self.read_variants(read, md, cigar)
+        self.decoding_seconds += time.time() - decoding_start
+        return variants, read.pos, alignment_end(read)
+
+    def summaries_pair(self, summary1, summary2):
+        '''pair_summary of the pair of two read summaries.'''
+        variants1, start1, end1 = summary1
+        variants2, start2, end2 = summary2
+        span = (max(start1, start2) + 1, min(end1, end2) + 1) if self.with_depth else None
+        if variants1 is None or variants2 is None:
+            return None, span
+        if not variants1 or not variants2:
+            return (), span
+        if variants2 < variants1:
+            return (variants2, variants1), span
+        return (variants1, variants2), span
+
+    def tally_pairs(self):
+        '''Add the variants shared by both reads of each distinct pair
+        counted so far to the number of pairs containing each variant in
+        the block.'''
+        decoding_start = time.time()
+        block_vars = self.block_vars
+        start = self.start
+        end = self.end
+        for (variants1, variants2), count in self.pair_counts.iteritems():
+            # find the variants each read in the pair share in common
+            for var in set(variants1).intersection(variants2):
+                # only consider variants within the bounds of the block
+                if start <= var[0] <= end:
+                    block_vars[var] = block_vars.get(var, 0) + count
+        self.distinct_pairs += len(self.pair_counts)
+        self.pair_counts = {}
+        self.decoding_seconds += time.time() - decoding_start
+
+    def add_orphan(self, read_name):
+        self.orphans += 1
+        if self.verbose:
+            logging.debug("read {} with no pair".format(read_name))
+
+    def add_multi_read_group(self, read_name):
+        self.multi_read_groups += 1
+        if self.verbose:
+            logging.debug("read {} with more than 2".format(read_name))
+
+    def result(self):
+        tally_start = time.time()
+        num_pairs = self.num_pairs
+        if self.max_pairs is not None:
+            for _priority, _read_name, reads in self.reservoir:
+                self.add_pair(reads[0], reads[1])
+            num_pairs = min(num_pairs, self.max_pairs)
+            self.reservoir = []
+        self.tally_pairs()
+        block_vars = self.block_vars
+        # pairs taken back by count_pair may leave variants in no pairs
+        for var in [var for var, count in block_vars.iteritems() if not count]:
+            del block_vars[var]
+        self.pairing_seconds += time.time() - tally_start
+        metrics = self.metrics
+        metrics['pairs'] = self.num_pairs
+        metrics['skipped_pairs'] = self.skipped_pairs
+        metrics['orphans'] = self.orphans
+        metrics['multi_read_groups'] = self.multi_read_groups
+        metrics['variants'] = len(block_vars)
+        metrics['decoding_seconds'] = self.decoding_seconds
+        metrics['pairing_seconds'] = self.pairing_seconds - self.decoding_seconds
+        if self.verbose:
+            logging.debug("number of reads intersecting block: {}".format(metrics['reads']))
+            logging.debug("number of reads sufficiently overlapping block: {}".format(metrics['overlapping_reads']))
+            logging.debug("number of read pairs in block: {}".format(self.num_pairs))
+            if num_pairs < self.num_pairs:
+                logging.debug("number of read pairs sampled: {}".format(num_pairs))
+            logging.debug("number of read pairs skipped by pre-filter: {}".format(self.skipped_pairs))
+            logging.debug("number of distinct pairs with variants in block: {}".format(self.distinct_pairs))
+            logging.debug("number of variants found in block: {}".format(len(block_vars)))
+        depth = None
+        if self.with_depth:
+            depth = pair_depth(self.start, self.end, self.pair_starts, self.pair_ends)
+            if self.retracted_starts:
+                depth -= pair_depth(self.start, self.end, self.retracted_starts, self.retracted_ends)
+        return BlockResult(self.chr, self.start, self.end, sorted(block_vars.items()),
+                           num_pairs, metrics, depth)
+
+# the states of the groups of reads of a PairMatcher
+waiting_read, single_read, read_pair, multi_read = range(4)
+
+class PairMatcher(object):
+    '''Group the reads of one block by name as they arrive in coordinate
+    order, like tally_block, but count each pair as soon as its second read
+    arrives, so that the reads of the block are not all held in memory.
+
+    A read whose mate is still to come (its mate is on the same chromosome,
+    at or after its position) waits under its name until the reads have
+    moved past the position of its mate. Any other read, and a waiting read
+    whose mate did not arrive, is counted as a read with no pair, and only
+    its summary (see BlockTally.read_summary) is kept, in case a secondary
+    or supplementary read with the same name arrives later.
+
+    Each group is kept as its state under its name until the end of the
+    block: a waiting read, the summary of a read with no pair, the signature
+    and span of a pair, or a group of more than 2 reads. So when another
+    read with the name of a pair arrives, the pair is taken back (with
+    BlockTally.count_pair) and the group counted as more than 2 reads, and
+    the groups, counts and calls are the same as those of tally_block. With
+    --maxpairs a pair can be taken back after the pair which would have
+    replaced it in the reservoir is gone, so the pairs are only sampled
+    from their signatures when the block is finished.'''
+    def __init__(self, tally):
+        self.tally = tally
+        # name -> (waiting_read, read), (single_read, read summary),
+        # (read_pair, signature, span) or (multi_read,)
+        self.groups = {}
+        # heap of (mate pos, name) of the waiting reads
+        self.expiry = []
+        self.num_waiting = 0
+        self.max_waiting = 0
+
+    def add(self, read):
+        add_start = time.time()
+        pos = read.pos
+        self.expire(pos)
+        name = read.qname
+        tally = self.tally
+        groups = self.groups
+        group = groups.get(name)
+        if group is None:
+            if read.is_paired and read.mrnm == read.tid and read.mpos >= pos:
+                groups[name] = (waiting_read, read)
+                heappush(self.expiry, (read.mpos, name))
+                self.num_waiting += 1
+                self.max_waiting = max(self.max_waiting, self.num_waiting)
+            else:
+                groups[name] = (single_read, tally.read_summary(read))
+                tally.add_orphan(name)
+        elif group[0] == waiting_read:
+            self.num_waiting -= 1
+            self.add_pair(name, tally.pair_summary(group[1], read))
+        elif group[0] == single_read:
+            tally.orphans -= 1
+            self.add_pair(name, tally.summaries_pair(group[1], tally.read_summary(read)))
+        elif group[0] == read_pair:
+            tally.num_pairs -= 1
+            if tally.max_pairs is None:
+                tally.count_pair(group[1], group[2], -1)
+            groups[name] = (multi_read,)
+            tally.add_multi_read_group(name)
+        tally.pairing_seconds += time.time() - add_start
+
+    def add_pair(self, name, pair_summary):
+        signature, span = pair_summary
+        tally = self.tally
+        tally.num_pairs += 1
+        if tally.max_pairs is None:
+            tally.count_pair(signature, span)
+        self.groups[name] = (read_pair, signature, span)
+
+    def expire(self, pos):
+        '''Count the waiting reads whose mate position is before pos as reads
+        with no pair.'''
+        expiry = self.expiry
+        groups = self.groups
+        tally = self.tally
+        while expiry and expiry[0][0] < pos:
+            _mate_pos, name = heappop(expiry)
+            group = groups[name]
+            # the read may have been paired already
+            if group[0] == waiting_read:
+                groups[name] = (single_read, tally.read_summary(group[1]))
+                self.num_waiting -= 1
+                tally.add_orphan(name)
+
+    def finish(self):
+        '''Count the reads still waiting at the end of the block as reads
+        with no pair, sample the pairs with --maxpairs, and return the
+        result of the block.'''
+        tally = self.tally
+        pairs = []
+        for name, group in self.groups.iteritems():
+            if group[0] == waiting_read:
+                tally.add_orphan(name)
+            elif group[0] == read_pair:
+                pairs.append((name, group[1], group[2]))
+        if tally.max_pairs is not None:
+            seed = tally.seed
+            # the pairs a reservoir of the lowest priorities would keep
+            for _priority, _name, signature, span in nlargest(
+                    tally.max_pairs, [(-pair_priority(seed, name), name, signature, span)
+                                      for name, signature, span in pairs]):
+                tally.count_pair(signature, span)
+        self.groups = {}
+        self.expiry = []
+        if tally.verbose:
+            logging.debug("largest number of reads waiting for their mate: {}".format(self.max_waiting))
+        return tally.result()
+
+def tally_block(args, chr, start, end, read_pairs, metrics):
+    '''Count the variants shared by both reads of each pair in one block.'''
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("processing block chr: {}, start: {}, end: {}".format(chr, start, end))
+    pairing_start = time.time()
+    # process all the reads in one block
+    tally = BlockTally(args, chr, start, end, metrics)
+    for read_name, reads in read_pairs.items():
+        tally.add_group(read_name, reads)
+    tally.pairing_seconds = time.time() - pairing_start
+    return tally.result()
+
+def fetch_matcher(args, bam, chr, start, end):
+    '''The PairMatcher of a block (--streampairs), given the reads of the
+    block as they are fetched, ready to finish.'''
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("processing block chr: {}, start: {}, end: {}".format(chr, start, end))
+    metrics = new_block_metrics()
+    block_start = time.time()
+    tally = BlockTally(args, chr, start, end, metrics)
+    matcher = PairMatcher(tally)
+    # use 0 based coordinates to lookup reads from bam file
+    start_col = start - 1
+    end_col = end - 1
+    min_overlap = args.overlap
+    for read in bam.fetch(chr, start_col, end_col + 1):
+        metrics['reads'] += 1
+        # only keep reads which overlap with the block region by a certain proportion
+        if proportion_overlap(start_col, end_col, read) > min_overlap:
+            metrics['overlapping_reads'] += 1
+            matcher.add(read)
+    metrics['fetch_seconds'] = time.time() - block_start - tally.pairing_seconds
+    return matcher
+
+def match_block(args, bam, chr, start, end):
+    '''process_block with --streampairs: pair the reads of the block with a
+    PairMatcher as they are fetched.'''
+    return fetch_matcher(args, bam, chr, start, end).finish()
+
+def process_block(args, bam, chr, start, end):
+    if args.streampairs:
+        return match_block(args, bam, chr, start, end)
+    metrics = new_block_metrics()
+    fetch_start = time.time()
+    # use 0 based coordinates to lookup reads from bam file
+    read_pairs = lookup_reads(args.overlap, bam, chr, start - 1, end - 1, metrics)
+    metrics['fetch_seconds'] = time.time() - fetch_start
+    return tally_block(args, chr, start, end, read_pairs, metrics)
+
+def sweep_blocks(args, bam, blocks):
+    '''Process the blocks of a coordinate sorted bam file by streaming the
+    reads of each chromosome once, instead of fetching the reads of each
+    block separately. blocks is a list of (chr, start, end) with 1 based
+    coordinates. The results are returned in the same order as blocks.'''
+    block_results = [None] * len(blocks)
+    chromosomes = []
+    chromosome_blocks = {}
+    for block_index, (chr, start, end) in enumerate(blocks):
+        if chr not in chromosome_blocks:
+            chromosomes.append(chr)
+            chromosome_blocks[chr] = []
+        chromosome_blocks[chr].append((start - 1, end - 1, block_index))
+    new_matcher = None
+    if args.streampairs:
+        def new_matcher(block_index, metrics):
+            chr, start, end = blocks[block_index]
+            return PairMatcher(BlockTally(args, chr, start, end, metrics))
+    for chr in chromosomes:
+        swept_blocks = sweep_reads(args.overlap, bam, chr, chromosome_blocks[chr], new_matcher)
+        if args.prefetch > 0:
+            swept_blocks = prefetched(swept_blocks, args.prefetch)
+        # stop the sweep before the bam file is closed, if a block fails
+        with closing(swept_blocks):
+            for block_index, read_pairs, metrics in swept_blocks:
+                if new_matcher is not None:
+                    # read_pairs is the PairMatcher of the block
+                    block_results[block_index] = read_pairs.finish()
+                    continue
+                chr, start, end = blocks[block_index]
+                block_results[block_index] = tally_block(args, chr, start, end, read_pairs, metrics)
+    return block_results
+
+def stream_blocks(args, bam, block_coords):
+    '''Process the blocks from a stream of reads in any order, as long as the
+    reads with the same name are next to each other, as in name collated
+    files or the output of an aligner. No index is needed: each group of
+    reads with the same name is assigned to the blocks its reads overlap as
+    soon as the group is complete, using the same tests as fetch. The
+    results are returned in the same order as the blocks.'''
+    blocks = block_coords
+    tallies = [BlockTally(args, chr, start, end, new_block_metrics())
+               for chr, start, end in blocks]
+    # for each reference id, the (start_col, end_col, block_index) of its
+    # blocks sorted by start, their starts, and the size of its largest block
+    chromosome_blocks = {}
+    for block_index, (chr, start, end) in enumerate(blocks):
+        tid = bam.gettid(chr)
+        if tid < 0:
+            logging.warning("chromosome {} of block {} {} is not in the stream".format(chr, start, end))
+            continue
+        chromosome_blocks.setdefault(tid, []).append((start - 1, end - 1, block_index))
+    chromosome_index = {}
+    for tid, intervals in chromosome_blocks.items():
+        intervals.sort()
+        chromosome_index[tid] = (intervals, [interval[0] for interval in intervals],
+                                 max(end_col - start_col for start_col, end_col, _index in intervals))
+    min_overlap = args.overlap
+
+    def add_group(read_name, reads):
+        group_start = time.time()
+        block_reads = {}
+        for read in reads:
+            index = chromosome_index.get(read.tid)
+            if index is None:
+                continue
+            intervals, starts, max_size = index
+            read_pos = read.pos
+            read_aend = alignment_end(read)
+            # the blocks which intersect the read: those which start before
+            # the end of the read, and end at or after its start
+            for interval_index in xrange(bisect_left(starts, read_pos - max_size),
+                                         bisect_right(starts, read_aend - 1)):
+                start_col, end_col, block_index = intervals[interval_index]
+                if end_col >= read_pos:
+                    metrics = tallies[block_index].metrics
+                    metrics['reads'] += 1
+                    # only keep reads which overlap with the block region by a certain proportion
+                    if proportion_overlap(start_col, end_col, read) > min_overlap:
+                        metrics['overlapping_reads'] += 1
+                        block_reads.setdefault(block_index, []).append(read)
+        for block_index, group in block_reads.items():
+            tally = tallies[block_index]
+            tally.add_group(read_name, group)
+            tally.pairing_seconds += time.time() - group_start
+
+    group_name = None
+    group = []
+    for read in bam.fetch(until_eof=True):
+        if read.qname != group_name:
+            if group:
+                add_group(group_name, group)
+            group_name = read.qname
+            group = [read]
+        else:
+            group.append(read)
+    if group:
+        add_group(group_name, group)
+    return [tally.result() for tally in tallies]
+
+def fetch_blocks(args, bam, blocks):
+    '''Fetch the reads of each block in turn, yielding (reads, metrics) for
+    each block, where reads is the read_pairs of lookup_reads. With
+    --streampairs the reads are paired as they are fetched, and reads is the
+    PairMatcher of the block (see fetch_matcher), so that only the reads
+    waiting for their mate are held, not all the reads of the blocks ahead.'''
+    for chr, start, end in blocks:
+        if args.streampairs:
+            matcher = fetch_matcher(args, bam, chr, start, end)
+            yield matcher, matcher.tally.metrics
+            continue
+        metrics = new_block_metrics()
+        fetch_start = time.time()
         # use 0 based coordinates to lookup reads from bam file
-        read_pairs = lookup_reads(args.overlap, bam, chr, start - 1, end - 1)
-        for read_name, reads in read_pairs.items():
-            if len(reads) == 1:
-                logging.warning("read {} with no pair".format(read_name))
-            elif len(reads) == 2:
-                num_pairs += 1
-                read1, read2 = reads
-                #print(read1.query)
-                #print([ord(x) - 33 for x in read1.qqual])
-                #print(read2.query)
-                #print([ord(x) - 33 for x in read2.qqual])
-                #exit()
-                read1_bases = make_base_seq(read1.qname, read1.query, read1.qqual)
-                read2_bases = make_base_seq(read2.qname, read2.query, read2.qqual)
-                variants1 = read_variants(args, read1.qname, chr, read1.pos + 1, read1_bases, read1.cigar, parse_md(get_MD(read1), []))
-                variants2 = read_variants(args, read2.qname, chr, read2.pos + 1, read2_bases, read2.cigar, parse_md(get_MD(read2), []))
-                set_variants1 = set(variants1)
-                set_variants2 = set(variants2)
-                # find the variants each read in the pair share in common
-                same_variants = set_variants1.intersection(set_variants2)
-                for var in same_variants:
-                    # only consider variants within the bounds of the block
-                    if var.pos >= start and var.pos <= end:
-                        if var in block_vars:
-                            block_vars[var] += 1
-                        else:
-                            block_vars[var] = 1
+        reads = lookup_reads(args.overlap, bam, chr, start - 1, end - 1, metrics)
+        metrics['fetch_seconds'] = time.time() - fetch_start
+        yield reads, metrics
+
+def prefetch_blocks(args, bam, blocks):
+    '''Process the blocks with the fetch engine, while the reads of the next
+    --prefetch blocks are fetched (and with --streampairs, paired) in a
+    background thread.'''
+    block_results = []
+    # stop the fetching before the bam file is closed, if a block fails
+    with closing(prefetched(fetch_blocks(args, bam, blocks), args.prefetch)) as fetched_blocks:
+        for (chr, start, end), (reads, metrics) in izip(blocks, fetched_blocks):
+            if args.streampairs:
+                # reads is the PairMatcher of the block
+                block_results.append(reads.finish())
             else:
-                logging.warning("read {} with more than 2".format(read_name))
-        logging.info("number of read pairs in block: {}".format(num_pairs))
-        logging.info("number of variants found in block: {}".format(len(block_vars)))
-        for var in block_vars:
-            num_vars = block_vars[var]
-            proportion = float(num_vars) / num_pairs
-            proportion_str = "{:.2f}".format(proportion)
-            if num_vars >= args.absthresh and proportion >= args.proportionthresh:
-                write_variant(kept_variants_file, var, sample)
+                block_results.append(tally_block(args, chr, start, end, reads, metrics))
+    return block_results
+
+def process_blocks(args, bam, block_coords):
+    blocks = block_coords
+    if args.engine == 'sweep':
+        return sweep_blocks(args, bam, blocks)
+    if args.prefetch > 0:
+        return prefetch_blocks(args, bam, blocks)
+    block_results = []
+    for chr, start, end in blocks:
+        block_results.append(process_block(args, bam, chr, start, end))
+    return block_results
+
+def proportion_interval(num_vars, num_pairs):
+    '''The Wilson score interval, of recheck_z standard deviations, of the
+    proportion of pairs containing a variant which was found in num_vars of
+    a sample of num_pairs pairs.'''
+    z_squared = recheck_z * recheck_z
+    proportion = float(num_vars) / num_pairs
+    scale = 1.0 + z_squared / num_pairs
+    centre = (proportion + z_squared / (2 * num_pairs)) / scale
+    spread = recheck_z * math.sqrt(proportion * (1.0 - proportion) / num_pairs +
+                                   z_squared / (4.0 * num_pairs * num_pairs)) / scale
+    return centre - spread, centre + spread
+
+def may_change_decision(args, num_vars, num_pairs, total_pairs):
+    '''Whether a variant found in num_vars of a sample of num_pairs read
+    pairs could be kept or binned differently if all total_pairs of them
+    were tallied. The variant is in num_vars of the pairs in the sample,
+    and in a proportion within the proportion_interval of the pairs which
+    were left out.'''
+    low, high = proportion_interval(num_vars, num_pairs)
+    unsampled_pairs = total_pairs - num_pairs
+    low_vars = num_vars + low * unsampled_pairs
+    high_vars = num_vars + high * unsampled_pairs
+    high_proportion = high_vars / total_pairs
+    if num_vars >= args.absthresh:
+        # all the pairs contain the variant at least as often as the sample
+        return low_vars / total_pairs < args.proportionthresh <= high_proportion
+    return high_proportion >= args.proportionthresh and high_vars >= args.absthresh
+
+def block_calls(args, block):
+    '''Decide whether to keep or bin each variant of a block, yielding its
+    (variant, num_vars, var_pairs, kept), where var_pairs is the number of
+    read pairs its proportion is computed from.'''
+    num_pairs = block.num_pairs
+    for var, num_vars in block.variants:
+        if args.positiondepth:
+            # a pair with an insertion after its last aligned base
+            # does not cover the position of the insertion
+            var_pairs = max(block.variant_depth(var), num_vars)
+        else:
+            var_pairs = num_pairs
+        proportion = float(num_vars) / var_pairs
+        kept = num_vars >= args.absthresh and proportion >= args.proportionthresh
+        yield var, num_vars, var_pairs, kept
+
+def write_block_results(args, kept_variants_file, binned_variants_file, sample, block_results, sinks=(),
+                        recheck_variants_file=None):
+    '''Write the kept and binned variants and the coverage file for one sample.
+    Every variant is also passed to the add_variant method of each of the
+    extra outputs in sinks. The variants of blocks whose pairs were sampled
+    (with --maxpairs) which may_change_decision are also written to
+    recheck_variants_file.'''
+    coverage_info = []
+    totals = new_block_metrics()
+    for block in block_results:
+        output_start = time.time()
+        num_pairs = block.num_pairs
+        total_pairs = block.total_pairs
+        sampled = recheck_variants_file is not None and num_pairs < total_pairs
+        kept_variants = 0
+        for var, num_vars, var_pairs, kept in block_calls(args, block):
+            if kept:
+                write_variant(kept_variants_file, block.chr, var, sample)
+                kept_variants += 1
             else:
-                write_variant(binned_variants_file, var, sample)
-        coverage_info.append((chr, start, end, num_pairs))
-    coverage_filename = sample + '.coverage'
-    if args.coverdir is not None:
-        coverage_filename = os.path.join(args.coverdir, coverage_filename)
+                write_variant(binned_variants_file, block.chr, var, sample)
+            if sampled and may_change_decision(args, num_vars, var_pairs,
+                                               var_pairs * float(total_pairs) / num_pairs):
+                write_variant(recheck_variants_file, block.chr, var, sample)
+            for sink in sinks:
+                sink.add_variant(sample, block.chr, var, num_vars, var_pairs, kept)
+        coverage_info.append((block.chr, block.start, block.end, num_pairs, total_pairs))
+        block.metrics['kept_variants'] = kept_variants
+        block.metrics['binned_variants'] = len(block.variants) - kept_variants
+        block.metrics['output_seconds'] = time.time() - output_start
+        add_metrics(totals, block.metrics)
+    logging.info("sample {}: {} reads, {} read pairs ({} skipped by pre-filter), "
+                 "{} reads with no pair, {} groups of more than 2 reads, "
+                 "{} variants kept, {} variants binned".format(
+        sample, totals['reads'], totals['pairs'], totals['skipped_pairs'],
+        totals['orphans'], totals['multi_read_groups'],
+        totals['kept_variants'], totals['binned_variants']))
+    coverage_filename = coverage_path(args, sample + '.coverage')
     with open(coverage_filename, 'w') as coverage_file:
-        coverage_file.write('chr\tblock_start\tblock_end\tnum_pairs\n')
-        for chr, start, end, num_pairs in sorted(coverage_info, key=itemgetter(3)):
-            coverage_file.write('{}\t{}\t{}\t{}\n'.format(chr, start, end, num_pairs))
+        if args.maxpairs is None:
+            coverage_file.write('chr\tblock_start\tblock_end\tnum_pairs\n')
+            for chr, start, end, num_pairs, _total_pairs in sorted(coverage_info, key=itemgetter(3)):
+                coverage_file.write('{}\t{}\t{}\t{}\n'.format(chr, start, end, num_pairs))
+        else:
+            coverage_file.write('chr\tblock_start\tblock_end\tnum_pairs\ttotal_pairs\n')
+            for chr, start, end, num_pairs, total_pairs in sorted(coverage_info, key=itemgetter(3)):
+                coverage_file.write('{}\t{}\t{}\t{}\t{}\n'.format(chr, start, end, num_pairs, total_pairs))
+    if args.depth:
+        write_depth(args, sample, block_results)
+
+def coverage_path(args, filename):
+    if args.coverdir is None:
+        return filename
+    return os.path.join(args.coverdir, filename)
+
+def write_depth(args, sample, block_results):
+    '''Write the depth arrays of all the blocks of a sample, one after the
+    other, to a single array in SAMPLE.depth.npy, which can be loaded with
+    numpy.load(filename, mmap_mode='r') without reading it all into memory.
+    SAMPLE.depth.index is a TSV of the blocks in the order they were
+    processed, with the offset of the first position of each block in the
+    array.'''
+    depth_filename = coverage_path(args, sample + '.depth.npy')
+    index_filename = coverage_path(args, sample + '.depth.index')
+    offset = 0
+    with open(index_filename, 'w') as index_file:
+        index_file.write('chr\tblock_start\tblock_end\toffset\n')
+        for block in block_results:
+            index_file.write('{}\t{}\t{}\t{}\n'.format(block.chr, block.start, block.end, offset))
+            offset += len(block.depth)
+    if block_results:
+        depth = np.concatenate([block.depth for block in block_results])
+    else:
+        depth = np.zeros(0, dtype=np.uint32)
+    np.save(depth_filename, depth)
 
 
 
 # output_header = '\t'.join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "NUM_PAIRS_WITH_VAR", "NUM_PAIRS_AT_POS", "PERCENT"])
 
-def process_bams(args):
-    block_coords = get_block_coords(args.primers)
+def block_contigs(block_coords):
+    '''The chromosomes of the blocks, in order of first appearance.'''
+    contigs = []
+    seen = set()
+    for block_info in block_coords:
+        chr = block_info[0]
+        if chr not in seen:
+            seen.add(chr)
+            contigs.append(chr)
+    return contigs
+
+def sample_name(bam_filename):
+    base = os.path.basename(bam_filename)
+    sample = base.split('.')
+    if len(sample) > 0:
+        return sample[0]
+    else:
+        exit('Cannot deduce sample name from bam filename {}'.format(bam_filename))
+
+def split_blocks(block_coords, num_chunks):
+    '''Split the blocks into (at most) num_chunks contiguous chunks of
+    roughly equal size, preserving their order.'''
+    num_chunks = max(1, min(num_chunks, len(block_coords)))
+    chunk_size, remainder = divmod(len(block_coords), num_chunks)
+    chunks = []
+    chunk_start = 0
+    for chunk_index in range(num_chunks):
+        chunk_end = chunk_start + chunk_size + (1 if chunk_index < remainder else 0)
+        chunks.append(block_coords[chunk_start:chunk_end])
+        chunk_start = chunk_end
+    return chunks
+
+def input_sample_name(args, bam_filename):
+    if bam_filename == stdin_filename:
+        return args.stdinsample
+    return sample_name(bam_filename)
+
+def profile_filename(args, bam_filename, chunk_index, num_chunks):
+    if num_chunks == 1:
+        return '{}.{}'.format(args.profile, input_sample_name(args, bam_filename))
+    return '{}.{}.{}'.format(args.profile, input_sample_name(args, bam_filename), chunk_index + 1)
+
+def open_alignments(args, bam_filename):
+    '''Open a bam file, a cram file (decoded with the --reference FASTA
+    file), or the stream of reads on standard input.'''
+    options = {}
+    if args.threads > 1:
+        options['threads'] = args.threads
+    if bam_filename == stdin_filename:
+        # htslib detects whether the stream is in sam or bam format
+        return pysam.Samfile(bam_filename, "r", **options)
+    if bam_filename.endswith('.cram'):
+        return pysam.Samfile(bam_filename, "rc", reference_filename=args.reference, **options)
+    return pysam.Samfile(bam_filename, "rb", **options)
+
+def process_bam_blocks(args, task):
+    '''Process a chunk of blocks from a single bam file. This is the unit of
+    work which is handed to the worker processes when --jobs is greater than
+    one. Each worker opens its own handle on the bam file. The stream on
+    standard input is always processed as a whole, in the main process.
+    Errors in the input are raised as InputError.'''
+    bam_filename, chunk_index, num_chunks, block_coords = task
+    if bam_filename == stdin_filename:
+        process = stream_blocks
+    else:
+        process = process_blocks
+    try:
+        with open_alignments(args, bam_filename) as bam:
+            logging.info("processing {} blocks from bam file {}".format(len(block_coords), bam_filename))
+            if args.profile is None:
+                return process(args, bam, block_coords)
+            profile = cProfile.Profile()
+            block_results = profile.runcall(process, args, bam, block_coords)
+            profile.dump_stats(profile_filename(args, bam_filename, chunk_index, num_chunks))
+            return block_results
+    except SystemExit as error:
+        # SystemExit is not an Exception, so a worker process which exits
+        # never gets its result back to the pool
+        raise InputError(str(error.code))
+
+def tally_record(sample, bam_filename, key, block_results):
+    '''The tally of a sample in the form saved in the tally store (see the
+    tally module). Each block is a list of its chromosome, start, end,
+    number of pairs, variants as [pos, ref, alt, count], metrics and
+    depths (or None).'''
+    blocks = []
+    for block in block_results:
+        variants = [[pos, ref, alt, num_vars] for (pos, ref, alt), num_vars in block.variants]
+        depth = None if block.depth is None else block.depth.tolist()
+        blocks.append([block.chr, block.start, block.end, block.num_pairs,
+                       variants, block.metrics, depth])
+    return {
+        'format': tally_format,
+        'rover_version': rover_version,
+        'sample': sample,
+        'bam': bam_filename,
+        'key': key,
+        'blocks': blocks,
+    }
+
+def tally_block_results(tally):
+    '''The block results of a tally from the tally store.'''
+    block_results = []
+    for chr, start, end, num_pairs, variants, metrics, depth in tally['blocks']:
+        variants = [((pos, intern(str(ref)), intern(str(alt))), num_vars)
+                    for pos, ref, alt, num_vars in variants]
+        metrics = dict((str(name), value) for name, value in metrics.items())
+        if depth is not None:
+            depth = np.array(depth, dtype=np.uint32)
+        block_results.append(BlockResult(str(chr), start, end, variants, num_pairs, metrics, depth))
+    return block_results
+
+def write_samples(args, sample_names, contigs, samples):
+    '''Write the kept and binned variants, the coverage files and the other
+    outputs for each (sample, bam_filename, block_results) in samples, in
+    order. sample_names and contigs are those of all the samples, which
+    the VCF output needs before any of the results.'''
+    sample_metrics = []
+    sinks = []
+    if args.vcf:
+        sinks.append(VcfOutput(args.out, sample_names, contigs, args.reference))
+    if args.matrix:
+        sinks.append(MatrixOutput(args.out, sample_names, contigs))
     with open(args.out, "w") as kept_variants_file, \
          open(args.out + '.binned', "w") as binned_variants_file:
         #kept_variants_file.write(output_header + '\n')
         #binned_variants_file.write(output_header + '\n')
-        for bam_filename in args.bams:
-            base = os.path.basename(bam_filename)
-            sample = base.split('.')
-            if len(sample) > 0:
-                sample = sample[0]
+        recheck_variants_file = None
+        if args.maxpairs is not None:
+            recheck_variants_file = open(args.out + '.recheck', "w")
+        if args.prefetch > 0:
+            kept_variants_file = BackgroundWriter(kept_variants_file)
+            binned_variants_file = BackgroundWriter(binned_variants_file)
+        for sample, bam_filename, block_results in samples:
+            write_block_results(args, kept_variants_file, binned_variants_file,
+                                sample, block_results, sinks, recheck_variants_file)
+            if args.metrics is not None:
+                metrics = SampleMetrics(sample, bam_filename)
+                for block in block_results:
+                    metrics.add_block(block.chr, block.start, block.end, block.metrics)
+                sample_metrics.append(metrics)
+        if args.prefetch > 0:
+            kept_variants_file.close()
+            binned_variants_file.close()
+        if recheck_variants_file is not None:
+            recheck_variants_file.close()
+    for sink in sinks:
+        sink.close()
+    if args.metrics is not None:
+        write_metrics(args.metrics, args.metricsformat, sample_metrics)
+
+def run_parameters(args):
+    '''The parameters of a run which affect its output, which must be the
+    same for all the shards of a run.'''
+    return {
+        'rover_version': rover_version,
+        'primers': file_digest(args.primers),
+        'bams': args.bams,
+        'samples': [input_sample_name(args, bam_filename) for bam_filename in args.bams],
+        'overlap': args.overlap,
+        'qualthresh': args.qualthresh,
+        'proportionthresh': args.proportionthresh,
+        'absthresh': args.absthresh,
+        'depth': args.depth,
+        'positiondepth': args.positiondepth,
+        'streampairs': args.streampairs,
+        'maxpairs': args.maxpairs,
+        'seed': args.seed,
+        'shardby': args.shardby,
+    }
+
+def process_bams(args, primer_index=None, pool=None, timeout=None):
+    '''Process the bam files of a run and write its outputs. rover serve
+    gives the primer index of the run, already loaded, and its own pool of
+    worker processes, which is used whatever the value of --jobs, and the
+    number of seconds to wait for each result of the pool before giving up
+    with a RuntimeError.'''
+    if primer_index is None:
+        primer_index = load_primers(args.primers)
+    block_coords = primer_index.blocks()
+    bams = args.bams
+    if args.shard is not None:
+        shard, num_shards = args.shard
+        if args.shardby == 'samples':
+            bams = shard_items(bams, shard, num_shards)
+        else:
+            if args.tallydir is not None:
+                exit('--tallydir cannot be used with --shardby blocks')
+            block_coords = shard_range(block_coords, shard, num_shards)
+        logging.info("shard {} of {}: {} bam files, {} blocks".format(
+            shard, num_shards, len(bams), len(block_coords)))
+    if args.splitblocks:
+        # Use more chunks than workers so that a chunk of unusually deep
+        # blocks does not hold up the whole sample.
+        chunks = split_blocks(block_coords, args.jobs * chunks_per_job)
+    else:
+        chunks = [block_coords]
+    if args.bams.count(stdin_filename) > 1:
+        exit('Standard input (-) can only be given once')
+    check_contigs(args, primer_index, bams)
+    store = None
+    keys = {}
+    stored = set()
+    if args.tallydir is not None:
+        store = TallyStore(args.tallydir)
+        primers_digest = file_digest(args.primers)
+        for bam_filename in bams:
+            if bam_filename == stdin_filename:
+                continue
+            key = tally_key(bam_filename, primers_digest, args.overlap, args.qualthresh,
+                            args.depth or args.positiondepth, args.maxpairs, args.seed)
+            keys[bam_filename] = key
+            if os.path.exists(store.filename(input_sample_name(args, bam_filename), key)):
+                stored.add(bam_filename)
+    tasks = [(bam_filename, chunk_index, len(chunks), chunk)
+             for bam_filename in bams
+             if bam_filename not in stored and bam_filename != stdin_filename
+             for chunk_index, chunk in enumerate(chunks)]
+    worker = partial(process_bam_blocks, args)
+    own_pool = None
+    if pool is not None:
+        results = pool.imap(worker, tasks)
+    elif args.jobs > 1 and len(tasks) > 1:
+        pool = own_pool = Pool(min(args.jobs, len(tasks)))
+        results = pool.imap(worker, tasks)
+    else:
+        results = imap(worker, tasks)
+
+    def next_result():
+        if timeout is None:
+            return next(results)
+        # a pool never gets the result of a worker process which died
+        try:
+            return results.next(timeout)
+        except TimeoutError:
+            raise RuntimeError('no result from the worker processes after {} seconds'.format(timeout))
+
+    def sample_results():
+        # imap yields results in the order of the tasks, so the output
+        # is the same regardless of how many jobs are used
+        for bam_filename in bams:
+            sample = input_sample_name(args, bam_filename)
+            if bam_filename == stdin_filename:
+                block_results = process_bam_blocks(args, (bam_filename, 0, 1, block_coords))
+            elif bam_filename in stored:
+                tally = store.load(sample, keys[bam_filename])
+                if tally is None:
+                    exit('Cannot load the saved tally of bam file {}'.format(bam_filename))
+                logging.info("using the saved tally of bam file {}".format(bam_filename))
+                block_results = tally_block_results(tally)
             else:
-                exit('Cannot deduce sample name from bam filename {}'.format(bam_filename))
-            with pysam.Samfile(bam_filename, "rb") as bam:
-                logging.info("processing bam file {}".format(bam_filename))
-                process_blocks(args, kept_variants_file,
-                               binned_variants_file, bam, sample, block_coords)
+                block_results = []
+                for chunk in chunks:
+                    block_results.extend(next_result())
+                if store is not None:
+                    store.save(tally_record(sample, bam_filename, keys[bam_filename], block_results))
+            yield sample, bam_filename, block_results
 
-def main():
-    args = parse_args()
-    if args.log is None:
-        logfile = sys.stdout
+    try:
+        if args.shard is None:
+            write_samples(args, [input_sample_name(args, bam_filename) for bam_filename in bams],
+                          block_contigs(block_coords), sample_results())
+        else:
+            write_shard(args, sample_results())
+    finally:
+        # the workers are idle unless an error stopped the run early
+        if own_pool is not None:
+            own_pool.terminate()
+            own_pool.join()
+
+def write_shard(args, samples):
+    '''Save the tallies of the samples processed by one shard, with the
+    parameters of the run, for rover merge.'''
+    shard, num_shards = args.shard
+    tallies = [tally_record(sample, bam_filename, None, block_results)
+               for sample, bam_filename, block_results in samples]
+    filename = shard_filename(args.out, shard, num_shards)
+    save_shard(filename, shard, num_shards, run_parameters(args), tallies)
+    logging.info("saved shard {} of {} to {}".format(shard, num_shards, filename))
+
+def merge(args):
+    '''Write the output of a sharded run from the partial results of all of
+    its shards, in the same order as a run without shards.'''
+    shards = load_shards(args.shards)
+    parameters = shards[0]['parameters']
+    # the thresholds, depths and sampling are those of the run
+    for name in ['proportionthresh', 'absthresh', 'depth', 'positiondepth']:
+        setattr(args, name, parameters[name])
+    args.maxpairs = parameters.get('maxpairs')
+    # the tallies of each sample, in shard order, which for shards of
+    # blocks is the order of the blocks
+    sample_tallies = {}
+    for shard in shards:
+        for tally in shard['tallies']:
+            sample_tallies.setdefault((tally['sample'], tally['bam']), []).append(tally)
+    sample_names = [str(sample) for sample in parameters['samples']]
+    contigs = block_contigs([block for shard in shards for tally in shard['tallies']
+                             for block in tally['blocks']])
+
+    def sample_results():
+        for sample, bam_filename in zip(sample_names, parameters['bams']):
+            block_results = []
+            for tally in sample_tallies.get((sample, bam_filename), []):
+                block_results.extend(tally_block_results(tally))
+            yield sample, str(bam_filename), block_results
+
+    logging.info("merging {} shards of {} samples".format(len(shards), len(sample_names)))
+    write_samples(args, sample_names, contigs, sample_results())
+
+def recall(args):
+    '''Call the kept and binned variants of samples from their saved tallies.'''
+    tallies = []
+    for tally_filename in args.tallies:
+        tally = load_tally(tally_filename)
+        if (args.depth or args.positiondepth) and not tally['key']['depth']:
+            exit('Tally file {} was saved without the depth of each position'.format(tally_filename))
+        tallies.append(tally)
+    # write the coverage with the total pairs, and the variants to recheck,
+    # if the pairs of any of the tallies were sampled
+    max_pairs = [tally['key'].get('maxpairs') for tally in tallies]
+    args.maxpairs = max(max_pairs) if any(max_pairs) else None
+    contigs = block_contigs([block for tally in tallies for block in tally['blocks']])
+    samples = ((str(tally['sample']), str(tally['bam']), tally_block_results(tally))
+               for tally in tallies)
+    write_samples(args, [str(tally['sample']) for tally in tallies], contigs, samples)
+
+def index_primers(args):
+    try:
+        blocks = read_primer_tsv(args.primers)
+    except ValueError as error:
+        exit('Invalid primer file: {}'.format(error))
+    PrimerIndex(block_table(blocks)).save(args.index)
+
+def run_outputs(args):
+    '''The names of the files written by a run.'''
+    if args.shard is not None:
+        return [shard_filename(args.out, args.shard[0], args.shard[1])]
+    outputs = [args.out, args.out + '.binned']
+    if args.maxpairs is not None:
+        outputs.append(args.out + '.recheck')
+    for bam_filename in args.bams:
+        sample = input_sample_name(args, bam_filename)
+        outputs.append(coverage_path(args, sample + '.coverage'))
+        if args.depth:
+            outputs.append(coverage_path(args, sample + '.depth.npy'))
+            outputs.append(coverage_path(args, sample + '.depth.index'))
+    if args.vcf:
+        for prefix in [args.out, args.out + '.binned']:
+            outputs.extend([prefix + '.vcf.gz', prefix + '.vcf.gz.tbi'])
+    if args.matrix:
+        outputs.extend([args.out + suffix for suffix in
+                        ['.matrix.npz', '.matrix.variants.tsv', '.matrix.samples.tsv']])
+    if args.metrics is not None:
+        outputs.append(args.metrics)
+    return outputs
+
+def parse_job(argv):
+    '''The arguments of a job of rover serve, from the arguments of a rover
+    command line. Raises ValueError if they are invalid.'''
+    args = parse_args(argv, JobArgumentParser)
+    if stdin_filename in args.bams:
+        raise ValueError('the jobs of rover serve cannot read standard input')
+    return args
+
+def serve(args):
+    '''Run jobs submitted over HTTP, with a pool of worker processes and
+    the primer indexes kept between jobs (see the server module).'''
+    pool = Pool(args.workers)
+    primer_cache = PrimerIndexCache()
+
+    def run_job(job_args):
+        primer_index = load_primers(job_args.primers, primer_cache)
+        try:
+            process_bams(job_args, primer_index, pool, args.timeout)
+        except InputError as error:
+            exit(str(error))
+        return run_outputs(job_args)
+
+    job_queue = JobQueue(parse_job, run_job, args.concurrency, args.queue, serve_finished_jobs)
+    server = make_server(job_queue, rover_version, args.port, args.socket)
+    if args.socket is None:
+        logging.info("serving on http://127.0.0.1:{}/".format(server.server_address[1]))
     else:
-        logfile = args.log
+        logging.info("serving on Unix socket {}".format(args.socket))
+    logging.info("{} worker processes, {} jobs at once, {} jobs queued at most, "
+                 "{} seconds for each chunk of blocks at most".format(
+        args.workers, args.concurrency, args.queue, args.timeout))
+
+    def terminate(signal_number, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("stopped, abandoning {} running and {} queued jobs".format(
+            job_queue.counts()['running'], job_queue.counts()['queued']))
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        pool.terminate()
+        pool.join()
+
+def init_logging(args):
     logging.basicConfig(
         filename=args.log,
-        level=logging.DEBUG,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         filemode='w',
         format='%(asctime)s %(message)s',
         datefmt='%m/%d/%Y %H:%M:%S')
     logging.info('program started')
     logging.info('command line: {0}'.format(' '.join(sys.argv)))
-    process_bams(args)
+
+def main():
+    if sys.argv[1:2] == ['recall']:
+        args = parse_recall_args(sys.argv[2:])
+        init_logging(args)
+        recall(args)
+        return
+    if sys.argv[1:2] == ['index']:
+        index_primers(parse_index_args(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ['merge']:
+        args = parse_merge_args(sys.argv[2:])
+        init_logging(args)
+        merge(args)
+        return
+    if sys.argv[1:2] == ['serve']:
+        args = parse_serve_args(sys.argv[2:])
+        init_logging(args)
+        serve(args)
+        return
+    args = parse_args()
+    init_logging(args)
+    try:
+        process_bams(args)
+    except InputError as error:
+        logging.error(str(error))
+        exit(str(error))
 
 
 
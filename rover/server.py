@@ -0,0 +1,223 @@
+'''
+A long running rover server (rover serve), for a stream of small samples,
+where starting a new rover process for each one would spend most of its
+time importing pysam, reading the primer file and starting worker
+processes.
+
+The server keeps the primer indexes it has read and a pool of worker
+processes between jobs. A job is a list of the same arguments as a rover
+command line. Jobs are submitted and monitored over HTTP, either on a port
+of localhost or on a Unix socket:
+
+    POST /jobs       submit a job, with a JSON body {"args": [...]}; the
+                     reply (202) is the status of the new job, or 400 if
+                     the arguments are invalid, or 503 if the queue is full
+    GET /jobs        the status of every job the server remembers
+    GET /jobs/ID     the status of one job
+    GET /status      the number of jobs waiting, running and finished
+
+The status of a job is a JSON object with its id, args, state (queued,
+running, done or failed), the times it was submitted, started and finished
+(in seconds since the epoch), the output files of a job which is done, and
+the error of a job which failed.
+
+At most a fixed number of jobs run at once, each in its own thread, and at
+most a fixed number wait in the queue. Only the most recent finished jobs
+are remembered.
+'''
+
+import os
+import json
+import time
+import logging
+import traceback
+from threading import (Thread, Lock)
+from Queue import (Queue, Full)
+from collections import OrderedDict
+from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+from SocketServer import (ThreadingMixIn, UnixStreamServer)
+
+job_states = ['queued', 'running', 'done', 'failed']
+
+class Job(object):
+    '''A job of the server: the arguments of one rover run.'''
+    def __init__(self, job_id, argv, args):
+        self.id = job_id
+        self.argv = argv
+        self.args = args
+        self.state = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.outputs = None
+        self.error = None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'args': self.argv,
+            'state': self.state,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'outputs': self.outputs,
+            'error': self.error,
+        }
+
+class JobQueue(object):
+    '''The jobs of the server. parse_job turns the arguments of a job into
+    the arguments of run_job, raising ValueError if they are invalid, and
+    run_job runs a job and returns the names of its output files. At most
+    concurrency jobs run at once, at most max_queued wait, and the last
+    max_finished finished jobs are remembered.'''
+    def __init__(self, parse_job, run_job, concurrency, max_queued, max_finished):
+        self.parse_job = parse_job
+        self.run_job = run_job
+        self.max_finished = max_finished
+        self.queue = Queue(maxsize=max_queued)
+        # id -> Job, in order of submission
+        self.jobs = OrderedDict()
+        self.finished = []
+        self.next_id = 1
+        self.lock = Lock()
+        self.runners = []
+        for runner_index in range(concurrency):
+            runner = Thread(target=self.run, name='job-runner-{}'.format(runner_index + 1))
+            runner.daemon = True
+            runner.start()
+            self.runners.append(runner)
+
+    def submit(self, argv):
+        '''Queue a job, raising ValueError if its arguments are invalid, or
+        Full if the queue is full.'''
+        args = self.parse_job(argv)
+        with self.lock:
+            job = Job(str(self.next_id), argv, args)
+            self.queue.put_nowait(job)
+            self.next_id += 1
+            self.jobs[job.id] = job
+        logging.info("job {} queued: {}".format(job.id, ' '.join(argv)))
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def all_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def counts(self):
+        '''The number of jobs the server remembers in each state.'''
+        counts = dict((state, 0) for state in job_states)
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job.state] += 1
+        return counts
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                job.state = 'running'
+                job.started = time.time()
+            logging.info("job {} started".format(job.id))
+            try:
+                outputs = self.run_job(job.args)
+            except SystemExit as error:
+                # rover reports errors in its input with exit(message)
+                self.finish(job, 'failed', error=str(error.code))
+            except Exception as error:
+                logging.error(traceback.format_exc())
+                self.finish(job, 'failed', error='{}: {}'.format(type(error).__name__, error))
+            else:
+                self.finish(job, 'done', outputs=outputs)
+
+    def finish(self, job, state, outputs=None, error=None):
+        with self.lock:
+            job.state = state
+            job.finished = time.time()
+            job.outputs = outputs
+            job.error = error
+            self.finished.append(job.id)
+            # forget the oldest finished jobs
+            while len(self.finished) > self.max_finished:
+                del self.jobs[self.finished.pop(0)]
+        logging.info("job {} {} in {:.2f} seconds{}".format(job.id, state,
+            job.finished - job.started, '' if error is None else ': ' + error))
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''The HTTP interface of a JobQueue (the job_queue of the server).'''
+    def do_GET(self):
+        job_queue = self.server.job_queue
+        path = self.path.rstrip('/')
+        if path == '/status':
+            self.send_json(200, {'version': self.server.version, 'jobs': job_queue.counts()})
+        elif path == '/jobs':
+            self.send_json(200, [job.as_dict() for job in job_queue.all_jobs()])
+        elif path.startswith('/jobs/'):
+            job = job_queue.get(path[len('/jobs/'):])
+            if job is None:
+                self.send_json(404, {'error': 'no such job'})
+            else:
+                self.send_json(200, job.as_dict())
+        else:
+            self.send_json(404, {'error': 'no such resource'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'no such resource'})
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            argv = request['args']
+            if not isinstance(argv, list) or not all(isinstance(arg, basestring) for arg in argv):
+                raise ValueError('args must be a list of strings')
+            job = self.server.job_queue.submit([str(arg) for arg in argv])
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {'error': str(error)})
+        except Full:
+            self.send_json(503, {'error': 'the job queue is full'})
+        else:
+            self.send_json(202, job.as_dict(), location='/jobs/' + job.id)
+
+    def send_json(self, code, data, location=None):
+        body = json.dumps(data) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if location is not None:
+            self.send_header('Location', location)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the client address of a Unix socket is not a (host, port) pair
+        logging.debug("request: " + format % args)
+
+class TCPJobServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class UnixJobServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # a socket left behind by a server which was killed
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        # used by BaseHTTPRequestHandler, as set by HTTPServer.server_bind
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def make_server(job_queue, version, port=None, socket_filename=None):
+    '''An HTTP server for job_queue on a port of localhost, or on a Unix
+    socket if socket_filename is given.'''
+    if socket_filename is not None:
+        server = UnixJobServer(socket_filename, RequestHandler)
+    else:
+        server = TCPJobServer(('127.0.0.1', port), RequestHandler)
+    server.job_queue = job_queue
+    server.version = version
+    return server
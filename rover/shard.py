@@ -0,0 +1,90 @@
+'''
+Scatter/gather runs: split the work of one rover run into shards which can
+run on different hosts, and merge their partial results.
+
+Shard I of N (rover --shard I/N) processes either every Nth sample,
+starting from sample I, or the Ith of N contiguous runs of primer blocks for
+all the samples (--shardby). Instead of the kept and binned variants it
+writes its partial result to OUT.shard-I-of-N.json.gz: the tallies of its
+samples (see the tally module), with the parameters of the run. The
+parameters include everything which affects the output, so rover merge can
+check that all N shards are present and belong to the same run before it
+writes the same kept, binned and coverage files a single run would have.
+
+The files are written in one step (see tally.save_json), so a shard file is
+either complete or absent, and no scheduler is needed: each shard can be
+run by hand, by a cluster job array, or in a loop over hosts, as long as
+they share the filesystem where the results are written.
+'''
+
+import re
+import glob
+from tally import (save_json, load_json)
+
+# version of the layout of the shard files
+shard_format = 1
+
+shard_regex = re.compile('^([0-9]+)/([0-9]+)$')
+
+def parse_shard(text):
+    '''Parse a --shard argument of the form I/N, where 1 <= I <= N.'''
+    match = shard_regex.match(text)
+    if match is None:
+        raise ValueError('shard must be of the form I/N, not {}'.format(text))
+    shard, num_shards = int(match.group(1)), int(match.group(2))
+    if not 1 <= shard <= num_shards:
+        raise ValueError('shard number must be between 1 and {}, not {}'.format(num_shards, shard))
+    return shard, num_shards
+
+def shard_filename(out, shard, num_shards):
+    return '{}.shard-{}-of-{}.json.gz'.format(out, shard, num_shards)
+
+def shard_items(items, shard, num_shards):
+    '''Every num_shards-th item, starting from item number shard (from 1).'''
+    return items[shard - 1::num_shards]
+
+def shard_range(items, shard, num_shards):
+    '''The shard-th of num_shards contiguous ranges of items, as equal in
+    size as possible. Some ranges are empty if there are fewer items than
+    shards.'''
+    start = len(items) * (shard - 1) // num_shards
+    end = len(items) * shard // num_shards
+    return items[start:end]
+
+def save_shard(filename, shard, num_shards, parameters, tallies):
+    save_json(filename, {
+        'format': shard_format,
+        'shard': shard,
+        'shards': num_shards,
+        'parameters': parameters,
+        'tallies': tallies,
+    })
+
+def load_shards(filenames):
+    '''Load the shard files of a run, and check that there is exactly one of
+    each shard and that they have the same parameters. A single name of the
+    form OUT.shard-I-of-N.json.gz stands for all the shards of the run. The
+    shards are returned in order.'''
+    if len(filenames) == 1:
+        match = re.match('^(.*)\.shard-[0-9]+-of-([0-9]+)\.json\.gz$', filenames[0])
+        if match is not None:
+            filenames = glob.glob('{}.shard-*-of-{}.json.gz'.format(match.group(1), match.group(2)))
+    shards = {}
+    num_shards = parameters = None
+    for filename in filenames:
+        shard = load_json(filename)
+        if shard.get('format') != shard_format:
+            exit('Shard file {} has an unsupported format'.format(filename))
+        if num_shards is None:
+            num_shards = shard['shards']
+            parameters = shard['parameters']
+        elif shard['shards'] != num_shards or shard['parameters'] != parameters:
+            exit('Shard file {} does not belong to the same run as {}'.format(
+                filename, filenames[0]))
+        if shard['shard'] in shards:
+            exit('Shard {} of {} is given more than once'.format(shard['shard'], num_shards))
+        shards[shard['shard']] = shard
+    missing = [str(shard) for shard in range(1, num_shards + 1) if shard not in shards]
+    if missing:
+        exit('Missing shards {} of {}'.format(', '.join(missing), num_shards))
+    return [shards[shard] for shard in range(1, num_shards + 1)]
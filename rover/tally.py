@@ -0,0 +1,130 @@
+'''
+A store of the raw variant tallies of each sample, so that the kept and
+binned variants can be called again with different thresholds without
+reading the bam files.
+
+The tally of a sample is everything rover knows about it before the
+--absthresh and --proportionthresh tests are applied: for every block, the
+number of read pairs, the number of pairs containing each variant, the
+block metrics and (with --depth or --positiondepth) the depth of each
+position. It depends only on the bam file, the primer file, --overlap,
+--qualthresh, whether depths were computed and the sampling of the pairs,
+so those make up its key:
+
+    bam        the size and modification time of the bam file
+    index      the size and modification time of its index, if there is one
+    primers    the SHA-1 digest of the contents of the primer file
+    overlap    the value of --overlap
+    qualthresh the value of --qualthresh
+    depth      whether the depth of each position was computed
+    maxpairs   the value of --maxpairs
+    seed       the value of --seed, if --maxpairs was given
+
+Each tally is a gzip compressed JSON file in the store directory, named
+SAMPLE.DIGEST.tally.json.gz, where DIGEST is taken from the key, so the
+tallies of a sample for different settings are kept side by side. A tally
+whose key no longer matches (because the bam file was rewritten, say) is
+simply not found.
+'''
+
+import os
+import json
+import gzip
+import hashlib
+import socket
+
+# version of the layout of the tally files
+tally_format = 1
+# bytes of the primer file hashed at a time
+hash_chunk_size = 1 << 20
+
+def file_identity(filename):
+    '''The size and modification time of a file, or None if it does not exist.'''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+def index_identity(bam_filename):
+    '''The identity of the index of a bam file, trying the usual names.'''
+    root, _ext = os.path.splitext(bam_filename)
+    for index_filename in [bam_filename + '.bai', root + '.bai', bam_filename + '.csi',
+                           bam_filename + '.crai']:
+        identity = file_identity(index_filename)
+        if identity is not None:
+            return identity
+    return None
+
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        while True:
+            data = file.read(hash_chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def tally_key(bam_filename, primers_digest, overlap, qualthresh, depth, maxpairs=None, seed=None):
+    return {
+        'format': tally_format,
+        'bam': file_identity(bam_filename),
+        'index': index_identity(bam_filename),
+        'primers': primers_digest,
+        'overlap': overlap,
+        'qualthresh': qualthresh,
+        'depth': depth,
+        'maxpairs': maxpairs,
+        'seed': seed if maxpairs is not None else None,
+    }
+
+def key_digest(key):
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()[:16]
+
+class TallyStore(object):
+    '''The tallies of samples in one directory, which is created if needed.'''
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, sample, key):
+        return os.path.join(self.directory,
+                            '{}.{}.tally.json.gz'.format(sample, key_digest(key)))
+
+    def load(self, sample, key):
+        '''The tally of a sample with a matching key, or None.'''
+        filename = self.filename(sample, key)
+        if not os.path.exists(filename):
+            return None
+        tally = load_tally(filename)
+        if tally['key'] != key:
+            return None
+        return tally
+
+    def save(self, tally):
+        '''Save a tally, replacing the file in one step so that a run which
+        is interrupted never leaves a partial tally behind.'''
+        filename = self.filename(tally['sample'], tally['key'])
+        save_json(filename, tally)
+        return filename
+
+def save_json(filename, data):
+    '''Write data to a gzip compressed JSON file, through a temporary file
+    which is renamed when it is complete, so that other processes (perhaps
+    on other hosts sharing the filesystem) never see a partial file.'''
+    temp_filename = '{}.{}.{}.tmp'.format(filename, socket.gethostname(), os.getpid())
+    with gzip.open(temp_filename, 'wb') as file:
+        json.dump(data, file, separators=(',', ':'))
+    os.rename(temp_filename, filename)
+
+def load_json(filename):
+    with gzip.open(filename, 'rb') as file:
+        return json.load(file)
+
+def load_tally(filename):
+    tally = load_json(filename)
+    if tally.get('format') != tally_format:
+        exit('Tally file {} has an unsupported format'.format(filename))
+    return tally
@@ -0,0 +1,151 @@
+'''
+Block compressed, tabix indexed VCF output of kept and binned variants.
+
+Rover describes an insertion by the position of the reference base which
+follows it, and a deletion by the position of its first deleted base, with
+'-' standing for the missing allele. VCF instead anchors both on the
+reference base before the variant, which is taken from the reference FASTA
+file when one is given, and is written as N otherwise.
+
+Each variant is one record, with a column for each sample. The FORMAT
+fields of a sample are the number of read pairs containing the variant
+(NP), the number of read pairs in the block (DP) and their ratio (PR). The
+INFO fields summarise the samples which have the variant. If a sample has
+the same variant in more than one (overlapping) block, the block with the
+most read pairs is reported.
+
+The records are collected in memory as the samples are processed and
+written out sorted by position when the output is closed, in batches, to
+an uncompressed file which tabix then compresses and indexes.
+'''
+
+import pysam
+
+# number of lines written to the file at a time
+write_batch_size = 10000
+
+header_lines = [
+    '##fileformat=VCFv4.1',
+    '##INFO=<ID=NS,Number=1,Type=Integer,Description="Number of samples with the variant">',
+    '##INFO=<ID=NP,Number=1,Type=Integer,Description="Total number of read pairs containing the variant">',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total number of read pairs in the blocks of the samples with the variant">',
+    '##INFO=<ID=PR,Number=1,Type=Float,Description="Proportion of read pairs containing the variant (NP/DP)">',
+    '##FILTER=<ID=binned,Description="Variant did not pass the proportion or absolute threshold">',
+    '##FORMAT=<ID=NP,Number=1,Type=Integer,Description="Number of read pairs containing the variant">',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Number of read pairs in the block (covering the variant, with --positiondepth)">',
+    '##FORMAT=<ID=PR,Number=1,Type=Float,Description="Proportion of read pairs containing the variant (NP/DP)">',
+]
+
+def proportion_str(num_vars, num_pairs):
+    return '{:.4f}'.format(float(num_vars) / num_pairs)
+
+class VcfWriter(object):
+    '''Collect the variants of all samples which go to one VCF file.'''
+    def __init__(self, filename, filter, samples, contigs, reference=None):
+        # tabix adds the .gz suffix when it compresses the file
+        if filename.endswith('.gz'):
+            filename = filename[:-3]
+        self.filename = filename
+        self.filter = filter
+        self.samples = samples
+        self.sample_indices = dict((sample, index) for index, sample in enumerate(samples))
+        self.contigs = contigs
+        self.contig_order = dict((chr, index) for index, chr in enumerate(contigs))
+        self.reference = reference
+        # (chr, pos, ref, alt) -> {sample index: (num_vars, num_pairs)}
+        self.records = {}
+
+    def add(self, sample, chr, variant, num_vars, num_pairs):
+        pos, ref, alt = variant
+        calls = self.records.setdefault((chr, pos, ref, alt), {})
+        sample_index = self.sample_indices[sample]
+        if sample_index not in calls or calls[sample_index][1] < num_pairs:
+            calls[sample_index] = (num_vars, num_pairs)
+
+    def anchor_base(self, chr, pos):
+        '''The reference base at 1 based position pos.'''
+        if self.reference is None or pos < 1:
+            return 'N'
+        return self.reference.fetch(chr, pos - 1, pos).upper() or 'N'
+
+    def vcf_alleles(self, chr, pos, ref, alt):
+        '''Convert a variant from rover's notation to VCF's.'''
+        if ref == '-':
+            # insertion before pos
+            anchor = self.anchor_base(chr, pos - 1)
+            return pos - 1, anchor, anchor + alt
+        elif alt == '-':
+            # deletion starting at pos
+            anchor = self.anchor_base(chr, pos - 1)
+            return pos - 1, anchor + ref, anchor
+        return pos, ref, alt
+
+    def sort_key(self, key):
+        chr, pos, ref, alt = key
+        return (self.contig_order.get(chr, len(self.contigs)), chr) + self.vcf_alleles(chr, pos, ref, alt)
+
+    def header(self):
+        lines = list(header_lines)
+        for chr in self.contigs:
+            if self.reference is not None and chr in self.reference.references:
+                lines.append('##contig=<ID={},length={}>'.format(
+                    chr, self.reference.get_reference_length(chr)))
+            else:
+                lines.append('##contig=<ID={}>'.format(chr))
+        lines.append('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+                                'INFO', 'FORMAT'] + self.samples))
+        return '\n'.join(lines) + '\n'
+
+    def record(self, key):
+        chr, pos, ref, alt = key
+        calls = self.records[key]
+        vcf_pos, vcf_ref, vcf_alt = self.vcf_alleles(chr, pos, ref, alt)
+        total_vars = sum(num_vars for num_vars, _num_pairs in calls.values())
+        total_pairs = sum(num_pairs for _num_vars, num_pairs in calls.values())
+        info = 'NS={};NP={};DP={};PR={}'.format(len(calls), total_vars, total_pairs,
+            proportion_str(total_vars, total_pairs))
+        columns = [chr, str(vcf_pos), '.', vcf_ref, vcf_alt, '.', self.filter, info, 'NP:DP:PR']
+        for sample_index in range(len(self.samples)):
+            if sample_index in calls:
+                num_vars, num_pairs = calls[sample_index]
+                columns.append('{}:{}:{}'.format(num_vars, num_pairs,
+                    proportion_str(num_vars, num_pairs)))
+            else:
+                columns.append('.')
+        return '\t'.join(columns) + '\n'
+
+    def close(self):
+        with open(self.filename, 'w') as vcf_file:
+            vcf_file.write(self.header())
+            batch = []
+            for key in sorted(self.records, key=self.sort_key):
+                batch.append(self.record(key))
+                if len(batch) >= write_batch_size:
+                    vcf_file.write(''.join(batch))
+                    batch = []
+            vcf_file.write(''.join(batch))
+        # compresses the file with bgzip (removing the uncompressed file)
+        # and writes the .tbi index
+        pysam.tabix_index(self.filename, preset='vcf', force=True)
+
+class VcfOutput(object):
+    '''The kept and binned VCF outputs of a run, written to PREFIX.vcf.gz and
+    PREFIX.binned.vcf.gz.'''
+    def __init__(self, prefix, samples, contigs, reference_filename=None):
+        self.reference = None
+        if reference_filename is not None:
+            self.reference = pysam.Fastafile(reference_filename)
+        self.kept = VcfWriter(prefix + '.vcf', 'PASS', samples, contigs, self.reference)
+        self.binned = VcfWriter(prefix + '.binned.vcf', 'binned', samples, contigs, self.reference)
+
+    def add_variant(self, sample, chr, variant, num_vars, num_pairs, kept):
+        if kept:
+            self.kept.add(sample, chr, variant, num_vars, num_pairs)
+        else:
+            self.binned.add(sample, chr, variant, num_vars, num_pairs)
+
+    def close(self):
+        self.kept.close()
+        self.binned.close()
+        if self.reference is not None:
+            self.reference.close()
@@ -36,6 +36,7 @@ setup(
         'depth of coverage across amplicons to facilitate the identification '
         'of any regions that may require further screening.'),
     install_requires=[
-        "pysam >= 0.7.5"
+        "pysam >= 0.8.1",
+        "numpy"
     ],
 )